@@ -0,0 +1,43 @@
+"""Add unique product constraint to CartItem
+
+Revision ID: 8c1f4a2d9e57
+Revises: 33750bff3a9b
+Create Date: 2026-10-18 10:12:41.204113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '8c1f4a2d9e57'
+down_revision: Union[str, None] = '33750bff3a9b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # Merge duplicate items left by concurrent adds into the oldest item of each cart and product
+    op.execute("""
+        UPDATE cart_item
+        SET quantity = duplicates.quantity
+        FROM (
+            SELECT min(id) AS id, sum(quantity) AS quantity
+            FROM cart_item
+            GROUP BY cart_id, product_id
+            HAVING count(*) > 1
+        ) AS duplicates
+        WHERE cart_item.id = duplicates.id
+    """)
+    op.execute("""
+        DELETE FROM cart_item
+        USING cart_item AS kept
+        WHERE cart_item.cart_id = kept.cart_id
+            AND cart_item.product_id = kept.product_id
+            AND cart_item.id > kept.id
+    """)
+    op.create_unique_constraint('uq_cart_item_cart_id_product_id', 'cart_item', ['cart_id', 'product_id'])
+
+
+def downgrade():
+    op.drop_constraint('uq_cart_item_cart_id_product_id', 'cart_item', type_='unique')
@@ -0,0 +1,43 @@
+"""Add webhook event table
+
+Revision ID: a6d3b9e04f21
+Revises: f3a8c6e21d05
+Create Date: 2026-10-18 14:21:07.318264
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6d3b9e04f21'
+down_revision: Union[str, None] = 'f3a8c6e21d05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.create_table(
+        'webhook_event',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('type', sa.String(), nullable=False),
+        sa.Column('ordering_key', sa.String(), nullable=True),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('received_at', sa.DateTime(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('locked_until', sa.DateTime(), nullable=True),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_webhook_event_status_next_attempt_at', 'webhook_event', ['status', 'next_attempt_at'])
+    op.create_index('ix_webhook_event_ordering_key_received_at', 'webhook_event', ['ordering_key', 'received_at'])
+
+
+def downgrade():
+    op.drop_index('ix_webhook_event_ordering_key_received_at', table_name='webhook_event')
+    op.drop_index('ix_webhook_event_status_next_attempt_at', table_name='webhook_event')
+    op.drop_table('webhook_event')
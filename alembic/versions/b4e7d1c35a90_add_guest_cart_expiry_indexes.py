@@ -0,0 +1,29 @@
+"""Add guest cart expiry indexes
+
+Revision ID: b4e7d1c35a90
+Revises: 8c1f4a2d9e57
+Create Date: 2026-10-18 11:03:17.582940
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4e7d1c35a90'
+down_revision: Union[str, None] = '8c1f4a2d9e57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.create_index('ix_cart_guest_id', 'cart', ['guest_id'])
+    op.create_index('ix_cart_updated_at', 'cart', ['updated_at'])
+    # Orders of purged carts are looked up by cart
+    op.create_index('ix_order_cart_id', 'order', ['cart_id'])
+
+
+def downgrade():
+    op.drop_index('ix_order_cart_id', table_name='order')
+    op.drop_index('ix_cart_updated_at', table_name='cart')
+    op.drop_index('ix_cart_guest_id', table_name='cart')
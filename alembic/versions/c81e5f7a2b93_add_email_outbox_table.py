@@ -0,0 +1,47 @@
+"""Add email outbox table
+
+Revision ID: c81e5f7a2b93
+Revises: a6d3b9e04f21
+Create Date: 2026-10-18 16:02:51.940317
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c81e5f7a2b93'
+down_revision: Union[str, None] = 'a6d3b9e04f21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.create_table(
+        'email_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('dedupe_key', sa.String(), nullable=True),
+        sa.Column('order_id', sa.Integer(), nullable=True),
+        sa.Column('recipients', sa.Text(), nullable=False),
+        sa.Column('subject', sa.String(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('locked_until', sa.DateTime(), nullable=True),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['order_id'], ['order.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('dedupe_key')
+    )
+    op.create_index('ix_email_outbox_status_next_attempt_at', 'email_outbox', ['status', 'next_attempt_at'])
+    op.create_index(op.f('ix_email_outbox_order_id'), 'email_outbox', ['order_id'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_email_outbox_order_id'), table_name='email_outbox')
+    op.drop_index('ix_email_outbox_status_next_attempt_at', table_name='email_outbox')
+    op.drop_table('email_outbox')
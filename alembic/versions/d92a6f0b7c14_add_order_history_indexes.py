@@ -0,0 +1,28 @@
+"""Add order history indexes
+
+Revision ID: d92a6f0b7c14
+Revises: b4e7d1c35a90
+Create Date: 2026-10-18 12:26:54.031877
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'd92a6f0b7c14'
+down_revision: Union[str, None] = 'b4e7d1c35a90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.create_index('ix_order_user_id_created_at_id', 'order', ['user_id', 'created_at', 'id'])
+    op.create_index('ix_order_guest_id_created_at_id', 'order', ['guest_id', 'created_at', 'id'])
+    op.create_index('ix_order_status_created_at', 'order', ['status', 'created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_order_status_created_at', table_name='order')
+    op.drop_index('ix_order_guest_id_created_at_id', table_name='order')
+    op.drop_index('ix_order_user_id_created_at_id', table_name='order')
@@ -0,0 +1,28 @@
+"""Add sensitive column to email outbox
+
+Revision ID: e4d7a9c2f618
+Revises: c81e5f7a2b93
+Create Date: 2026-10-18 19:12:40.518224
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4d7a9c2f618'
+down_revision: Union[str, None] = 'c81e5f7a2b93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.add_column('email_outbox', sa.Column('sensitive', sa.Boolean(), nullable=False, server_default=sa.false()))
+    # Password reset emails enqueued before the column existed, recognized by their subject
+    op.execute("UPDATE email_outbox SET sensitive = true WHERE subject = 'Zahtjev za resetiranje lozinke'")
+    op.execute("UPDATE email_outbox SET body = '' WHERE sensitive AND status IN ('sent', 'failed')")
+
+
+def downgrade():
+    op.drop_column('email_outbox', 'sensitive')
@@ -0,0 +1,31 @@
+"""Add checkout session columns to Order
+
+Revision ID: f3a8c6e21d05
+Revises: d92a6f0b7c14
+Create Date: 2026-10-18 13:08:42.661503
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a8c6e21d05'
+down_revision: Union[str, None] = 'd92a6f0b7c14'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.add_column('order', sa.Column('contents_hash', sa.String(length=64), nullable=True))
+    op.add_column('order', sa.Column('checkout_session_id', sa.String(), nullable=True))
+    op.add_column('order', sa.Column('checkout_url', sa.String(), nullable=True))
+    op.add_column('order', sa.Column('checkout_expires_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('order', 'checkout_expires_at')
+    op.drop_column('order', 'checkout_url')
+    op.drop_column('order', 'checkout_session_id')
+    op.drop_column('order', 'contents_hash')
@@ -1,13 +1,16 @@
 import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, create_refresh_token
+from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, create_refresh_token, current_user
 
+from api.identity import get_identity_claims
 from database.cart import Cart
 from database.user import User
-from notification.email_notification import send_password_reset_email
+from notification.email_notification import get_password_reset_email
+from notification.email_outbox import enqueue_emails
 from utils.common import is_valid_email
 from utils.constants import ResponseKey
 from utils.limiter import limiter
@@ -18,6 +21,9 @@ auth_blueprint = Blueprint('auth', __name__)
 RESET_PASSWORD_TOKEN_EXPIRY = timedelta(hours=1)
 reset_tokens = {}
 
+# Merges deferred off the sign-in request, merges of the same user are serialized by the database anyway
+_cart_merge_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cart-merge')
+
 
 @auth_blueprint.route('/sign-up', methods=['POST'])
 @limiter.limit("100/minute")
@@ -57,8 +63,8 @@ def sign_in():
         return jsonify({ResponseKey.ERROR.value: "Email does not exist"}), 401
 
     if User.verify_user(email, password):
-        access_token = create_access_token(identity=email)
-        refresh_token = create_refresh_token(identity=email)
+        access_token = create_access_token(identity=email, additional_claims=get_identity_claims(user))
+        refresh_token = create_refresh_token(identity=email, additional_claims=get_identity_claims(user))
         response = {
             ResponseKey.MESSAGE.value: "User successfully signed in",
             ResponseKey.ACCESS_TOKEN.value: access_token,
@@ -70,22 +76,34 @@ def sign_in():
         guest_id = data.get('guest_id')
         if guest_id:
             # TODO Should I create dedicated cart API to check if merge is required?
-            merge_result = Cart.merge_carts(guest_id, user_id)
-            if merge_result != "Cart merged successfully":
-                response[ResponseKey.CART_ERROR.value] = merge_result
+            if current_app.config.get('CART_MERGE_DEFERRED'):
+                _cart_merge_executor.submit(_merge_carts, current_app._get_current_object(), guest_id, user_id)
+                response[ResponseKey.CART_MESSAGE.value] = "Cart merge scheduled"
             else:
-                response[ResponseKey.CART_MESSAGE.value] = merge_result
+                merge_result = Cart.merge_carts(guest_id, user_id)
+                if merge_result != "Cart merged successfully":
+                    response[ResponseKey.CART_ERROR.value] = merge_result
+                else:
+                    response[ResponseKey.CART_MESSAGE.value] = merge_result
 
         return jsonify(response), 200
     else:
         return jsonify({ResponseKey.ERROR.value: "Invalid email or password"}), 401
 
 
+def _merge_carts(app, guest_id, user_id):
+    with app.app_context():
+        merge_result = Cart.merge_carts(guest_id, user_id)
+    if merge_result != "Cart merged successfully":
+        print(f"Failed to merge guest cart {guest_id} into cart of user {user_id}: {merge_result}")
+
+
 @auth_blueprint.route('/token/refresh', methods=['POST'])
 @jwt_required(refresh=True)
 def refresh():
-    current_user = get_jwt_identity()
-    new_token = create_access_token(identity=current_user, fresh=False)
+    new_token = create_access_token(
+        identity=get_jwt_identity(), additional_claims=get_identity_claims(current_user), fresh=False
+    )
     return jsonify({ResponseKey.ACCESS_TOKEN.value: new_token}), 200
 
 
@@ -115,7 +133,7 @@ def reset_password():
 
     client_url = os.getenv("CLIENT_URL")
     reset_link = f"{client_url}/reset-password?token={reset_token}"
-    send_password_reset_email(email, reset_link)
+    enqueue_emails([get_password_reset_email(email, reset_link)])
 
     return jsonify({ResponseKey.MESSAGE.value: "Password reset link has been sent to your email"}), 200
 
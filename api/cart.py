@@ -1,16 +1,20 @@
 from dataclasses import dataclass
+from typing import Optional
 
 from flask import Blueprint, request, jsonify
 
-from database.cart import Cart
+from database.cart import Cart, CartOperation
 from database.cart import CartItem as CartItemDb
 from database.user import User
-from payment.stripe_product import get_cached_product_by_id
+from payment.stripe_product import get_cached_product_by_id, get_discounted_unit_amount, StripeProduct
 from utils.constants import ResponseKey
 from utils.limiter import limiter
 
 cart_blueprint = Blueprint('cart', __name__)
 
+# Max number of operations in a single cart batch request
+_max_batch_operations = 100
+
 
 @cart_blueprint.route('/cart', methods=['GET'])
 @limiter.limit("100/minute")
@@ -22,11 +26,10 @@ def get_user_cart():
     if not is_valid:
         return jsonify({ResponseKey.ERROR.value: error_message}), 400
 
-    cart = Cart.get_cart_by_user_id(user_id=user_id, guest_id=guest_id)
+    cart = Cart.get_cart_by_user_id(user_id=user_id, guest_id=guest_id, with_items=True)
 
     if cart:
-        items = [map_to_cart(item) for item in cart.items]
-        return jsonify({ResponseKey.MESSAGE.value: "Cart successfully retrieved", "items": items}), 200
+        return _get_cart_response(cart, "Cart successfully retrieved")
     else:
         return jsonify({ResponseKey.ERROR.value: "Cart not found"}), 404
 
@@ -57,7 +60,7 @@ def add_item_to_cart():
 
     product = get_cached_product_by_id(product_id)
 
-    if product.default_price is None or quantity <= 0 or product.default_price.unit_amount < 0:
+    if product is None or product.default_price is None or quantity <= 0 or product.default_price.unit_amount < 0:
         return jsonify({ResponseKey.ERROR.value: "Invalid product_id, quantity, or price"}), 400
 
     try:
@@ -123,16 +126,123 @@ def remove_item_from_cart():
         return jsonify({ResponseKey.ERROR.value: message}), 400
 
 
+@cart_blueprint.route('/cart/batch', methods=['POST'])
+@limiter.limit("100/minute")
+def apply_cart_operations():
+    data = request.get_json()
+
+    if not data:
+        return jsonify({ResponseKey.ERROR.value: "Request data is required"}), 400
+
+    user_id = data.get('user_id')
+    guest_id = data.get('guest_id')
+
+    is_valid, error_message = User.validate_user_id(user_id, guest_id)
+    if not is_valid:
+        return jsonify({ResponseKey.ERROR.value: error_message}), 400
+
+    operations_data = data.get('operations')
+    if not isinstance(operations_data, list) or not operations_data:
+        return jsonify({ResponseKey.ERROR.value: "operations must be a non-empty list"}), 400
+
+    if len(operations_data) > _max_batch_operations:
+        return jsonify({ResponseKey.ERROR.value: f"At most {_max_batch_operations} operations are allowed"}), 400
+
+    operations = []
+    for operation_data in operations_data:
+        operation, error_message = _parse_cart_operation(operation_data)
+        if error_message:
+            return jsonify({ResponseKey.ERROR.value: error_message}), 400
+        operations.append(operation)
+
+    success, result = Cart.apply_cart_operations(
+        operations,
+        user_id=user_id if user_id else None,
+        guest_id=guest_id if not user_id else None
+    )
+    if not success:
+        return jsonify({ResponseKey.ERROR.value: result}), 500
+
+    if not result:
+        return jsonify({ResponseKey.ERROR.value: "Cart not found"}), 400
+
+    return _get_cart_response(result, "Cart successfully updated")
+
+
+def _get_cart_response(cart: Cart, message: str):
+    """
+    Prices cart items against the product cache in one pass. The total is only given when all priced items share
+    a currency, items of products no longer in the catalog have no price and are left out of it.
+    """
+    items = []
+    total_amount = 0
+    currencies = set()
+    for item in cart.items:
+        cart_item = map_to_cart(item, get_cached_product_by_id(item.product_id))
+        if cart_item.line_total is not None:
+            total_amount += cart_item.line_total
+            currencies.add(cart_item.currency)
+        items.append(cart_item)
+
+    is_single_currency = len(currencies) <= 1
+    return jsonify({
+        ResponseKey.MESSAGE.value: message,
+        "items": items,
+        ResponseKey.TOTAL_AMOUNT.value: total_amount if is_single_currency else None,
+        ResponseKey.CURRENCY.value: next(iter(currencies)) if len(currencies) == 1 else None
+    }), 200
+
+
+def _parse_cart_operation(data):
+    if not isinstance(data, dict):
+        return None, "Invalid operation format, must be an object"
+
+    try:
+        operation = CartOperation(data.get('operation'))
+    except ValueError:
+        return None, "Invalid operation, must be one of add, remove or set"
+
+    product_id = data.get('product_id')
+    if not product_id or not isinstance(product_id, str):
+        return None, "Invalid product_id format, must be a string"
+
+    quantity = data.get('quantity', 1)
+    if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0 or (
+            quantity == 0 and operation != CartOperation.SET):
+        return None, "Invalid quantity format or value"
+
+    if operation != CartOperation.REMOVE:
+        product = get_cached_product_by_id(product_id)
+        if product is None or product.default_price is None or product.default_price.unit_amount < 0:
+            return None, f"Invalid product_id or price: {product_id}"
+
+    return (operation, product_id, quantity), None
+
+
 @dataclass
 class CartItem:
     id: int
     product_id: str
     quantity: int
+    unit_price: Optional[int] = None
+    discounted_price: Optional[int] = None
+    line_total: Optional[int] = None
+    currency: Optional[str] = None
 
 
-def map_to_cart(item: CartItemDb) -> CartItem:
-    return CartItem(
+def map_to_cart(item: CartItemDb, product: Optional[StripeProduct] = None) -> CartItem:
+    cart_item = CartItem(
         id=item.id,
         product_id=item.product_id,
         quantity=item.quantity,
     )
+    if product is None or product.default_price is None:
+        return cart_item
+
+    # Same discounted price the order is created with
+    discounted_price = get_discounted_unit_amount(product)
+    cart_item.unit_price = product.default_price.unit_amount
+    cart_item.discounted_price = discounted_price
+    cart_item.line_total = discounted_price * item.quantity
+    cart_item.currency = product.default_price.currency
+    return cart_item
@@ -0,0 +1,48 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+from flask import jsonify
+from flask_jwt_extended import JWTManager
+
+from database.user import User
+from utils.constants import ResponseKey
+
+
+@dataclass
+class Identity:
+    """
+    User of the current request, resolved from the JWT claims without a query. The user row is loaded at most once per
+    request, when an endpoint needs more than the id.
+    """
+    id: int
+    email: str
+    loaded_user: Optional[User] = field(default=None, repr=False)
+
+    @property
+    def user(self) -> Optional[User]:
+        if self.loaded_user is None:
+            self.loaded_user = User.get_by_id(self.id)
+        return self.loaded_user
+
+
+def get_identity_claims(user) -> dict:
+    return {'user_id': user.id}
+
+
+def initialize_identity(jwt: JWTManager):
+    @jwt.user_lookup_loader
+    def load_identity(_jwt_header, jwt_data) -> Optional[Identity]:
+        email = jwt_data['sub']
+        user_id = jwt_data.get('user_id')
+
+        if user_id is None:
+            # Tokens issued before the user id claim was added
+            user = User.get_by_email(email)
+            return Identity(id=user.id, email=email, loaded_user=user) if user else None
+
+        # Users are never deleted, so the user of a valid token exists
+        return Identity(id=user_id, email=email)
+
+    @jwt.user_lookup_error_loader
+    def identity_not_found(_jwt_header, _jwt_data):
+        return jsonify({ResponseKey.ERROR.value: "User not found"}), 404
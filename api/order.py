@@ -1,21 +1,37 @@
+import hashlib
+import json
 import os
+from datetime import datetime, timedelta
 
 from flask import Blueprint, request, jsonify
+from sqlalchemy.exc import SQLAlchemyError
 
+from database import db
 from database.cart import Cart
 from database.order import Order, OrderStatus
 from database.user import User
-from notification.email_notification import send_order_confirmation_email_to_customer, \
-    send_order_confirmation_email_to_admin
-from payment.stripe_checkout import get_stripe_checkout_session, get_checkout_session_info, get_checkout_event, \
-    CheckoutSessionInfo
-from payment.stripe_product import get_cached_product_by_id
-from utils.common import safe_int
+from database.webhook_event import WebhookEvent
+from notification.email_notification import get_order_confirmation_email_to_customer, \
+    get_order_confirmation_email_to_admin
+from notification.email_outbox import enqueue_emails
+from payment.stripe_checkout import get_stripe_checkout_session, get_checkout_event, CheckoutSessionInfo, \
+    get_cached_checkout_session_info, get_checkout_session_info_from_session, cache_checkout_session_info
+from payment.stripe_product import get_cached_product_by_id, is_stripe_catalog_event, apply_stripe_catalog_event, \
+    get_discounted_unit_amount
+from payment.webhook_inbox import get_ordering_key, notify_webhook_inbox, PermanentWebhookError
+from utils.common import safe_int, encode_cursor, decode_cursor
 from utils.constants import ResponseKey
 from utils.limiter import limiter
 
 order_blueprint = Blueprint('order', __name__)
 
+_default_orders_page_size = 20
+_max_orders_page_size = 100
+# Pending order checkout session is reused only if it stays valid for at least this long
+_checkout_reuse_min_validity = timedelta(minutes=10)
+# Max time a checkout waits for a concurrent checkout of the same cart, which includes a Stripe call
+_checkout_lock_timeout = timedelta(seconds=10)
+
 
 @order_blueprint.route('/order', methods=['GET'])
 @limiter.limit("100/minute")
@@ -24,12 +40,62 @@ def get_order():
     user_id = request.args.get('user_id')
     guest_id = request.args.get('guest_id')
 
-    success, order = Order.get_order(order_id, user_id, guest_id)
+    success, result = Order.get_order(order_id, user_id, guest_id, with_items=True)
 
     if success:
-        return jsonify({ResponseKey.MESSAGE.value: "Order successfully retrieved", "order": order}), 200
+        return jsonify({ResponseKey.MESSAGE.value: "Order successfully retrieved", "order": result.to_dict()}), 200
     else:
-        return jsonify({ResponseKey.ERROR.value: order.to_dict()}), 404
+        return jsonify({ResponseKey.ERROR.value: result}), 404
+
+
+@order_blueprint.route('/orders', methods=['GET'])
+@limiter.limit("100/minute")
+def get_orders():
+    user_id = request.args.get('user_id')
+    guest_id = request.args.get('guest_id')
+    status = request.args.get('status')
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+
+    is_valid, error_message = User.validate_user_id(user_id, guest_id)
+    if not is_valid:
+        return jsonify({ResponseKey.ERROR.value: error_message}), 400
+
+    if status and status not in {order_status.value for order_status in OrderStatus}:
+        return jsonify({ResponseKey.ERROR.value: f"Invalid order status: {status}"}), 400
+
+    page_size = safe_int(limit) if limit is not None else _default_orders_page_size
+    if page_size is None or not 0 < page_size <= _max_orders_page_size:
+        return jsonify({ResponseKey.ERROR.value: f"Invalid limit, must be between 1 and {_max_orders_page_size}"}), 400
+
+    after = None
+    if cursor:
+        after = _decode_orders_cursor(cursor)
+        if after is None:
+            return jsonify({ResponseKey.ERROR.value: "Invalid cursor"}), 400
+
+    orders = Order.get_orders(user_id=user_id, guest_id=guest_id, status=status, after=after, limit=page_size)
+    page = orders[:page_size]
+    next_cursor = None
+    if len(orders) > page_size:
+        last_order = page[-1]
+        next_cursor = encode_cursor({'created_at': last_order.created_at.isoformat(), 'id': last_order.id})
+
+    return jsonify({
+        ResponseKey.MESSAGE.value: "Orders successfully retrieved",
+        "orders": [order.to_dict() for order in page],
+        "next_cursor": next_cursor
+    }), 200
+
+
+def _decode_orders_cursor(cursor):
+    decoded_cursor = decode_cursor(cursor)
+    if not isinstance(decoded_cursor, dict) or not isinstance(decoded_cursor.get('id'), int):
+        return None
+    try:
+        return datetime.fromisoformat(decoded_cursor.get('created_at')), decoded_cursor['id']
+    except (TypeError, ValueError):
+        return None
 
 
 @order_blueprint.route('/order/create', methods=['POST'])
@@ -42,115 +108,134 @@ def create_order():
 
     user_id = data.get('user_id')
     guest_id = data.get('guest_id')
-    cart = Cart.get_cart_by_user_id(user_id, guest_id)
-    if not cart:
-        return jsonify({ResponseKey.ERROR.value: "Cart does not exist"}), 404
-
-    if not cart.items or len(cart.items) == 0:
-        return jsonify({ResponseKey.ERROR.value: "No items in the cart"}), 400
 
     is_valid, error_message = User.validate_user_id(user_id, guest_id)
     if not is_valid:
         return jsonify({ResponseKey.ERROR.value: error_message}), 400
 
-    success, existing_order = Order.get_order_by_cart_id_for_status(cart_id=cart.id, status=OrderStatus.PENDING.value)
-    if success:
-        Order.cancel_order(existing_order.id)
+    # Concurrent checkouts of the cart are serialized by the cart row lock, held until the order and its checkout
+    # session are committed. The lock is released on every early return, when the request session is removed.
+    locked, cart = Cart.lock_cart_for_checkout(user_id, guest_id, lock_timeout=_checkout_lock_timeout)
+    if not locked:
+        return jsonify({ResponseKey.ERROR.value: cart}), 409
 
-    # Check if cart exists
-    success, result = Cart.get_cart_by_id(cart_id=cart.id)
-    if not success:
-        return jsonify({ResponseKey.ERROR.value: result}), 404
-    cart = result
+    if not cart:
+        return jsonify({ResponseKey.ERROR.value: "Cart does not exist"}), 404
 
-    items = cart.items
-    if not items:
+    if not cart.items:
         return jsonify({ResponseKey.ERROR.value: "No items in the cart"}), 400
 
-    success, result = Order.create_order(cart_id=cart.id, user_id=user_id, guest_id=guest_id)
-
-    if not success:
-        return jsonify({ResponseKey.ERROR.value: result}), 400
-
-    order = result
-
-    total_amount = 0.0
+    # Lines are priced in memory, then the order is created with all of its items in one transaction
+    order_items = []
     currency = None
-    for item in items:
-        product_id = item.product_id
-        quantity = item.quantity
-
-        product = get_cached_product_by_id(product_id)
+    for item in cart.items:
+        product = get_cached_product_by_id(item.product_id)
 
-        if product.default_price is None or quantity <= 0 or product.default_price.unit_amount < 0:
+        if product is None or product.default_price is None or item.quantity <= 0 or \
+                product.default_price.unit_amount < 0:
             return jsonify({ResponseKey.ERROR.value: "Invalid product_id, quantity, or price"}), 400
 
         if currency and currency != product.default_price.currency:
             return jsonify({ResponseKey.ERROR.value: "Different currencies in order items"}), 400
 
         currency = product.default_price.currency
-        total_amount += quantity * product.default_price.unit_amount
-
-        discount = product.metadata.get('discount')
-        price = product.default_price.unit_amount
-        # Lower the price for discount if exists
-        if discount and 0 < safe_int(discount) < 100:
-            price = product.default_price.unit_amount * (1 - safe_int(discount) / 100)
-
-        Order.add_item_to_order(
-            order_id=order.id,
-            product_id=product_id,
-            quantity=quantity,
-            price=price,
-            currency=currency
-        )
+        order_items.append({
+            'product_id': item.product_id,
+            'quantity': item.quantity,
+            # Lower the price for discount if exists
+            'price': get_discounted_unit_amount(product),
+            'currency': currency
+        })
+
+    # Repeated checkout of unchanged cart, including one that waited for the lock, returns the pending order and its
+    # checkout session
+    contents_hash = _get_contents_hash(order_items)
+    success, pending_order = Order.get_order_by_cart_id_for_status(cart_id=cart.id, status=OrderStatus.PENDING.value)
+    if success and _is_checkout_reusable(pending_order, contents_hash):
+        pending_order_id, checkout_url = pending_order.id, pending_order.checkout_url
+        db.session.commit()
+        return jsonify(
+            {
+                ResponseKey.MESSAGE.value: "Pending order checkout reused",
+                ResponseKey.ORDER_ID.value: pending_order_id,
+                ResponseKey.CHECKOUT_URL.value: checkout_url,
+            }
+        ), 200
 
-    order.update_total_amount(total_amount=total_amount)
+    success, result = Order.create_order(
+        cart_id=cart.id, items=order_items, user_id=user_id, guest_id=guest_id, contents_hash=contents_hash,
+        commit=False
+    )
 
-    checkout_created, result = _get_checkout_session(order)
+    if not success:
+        return jsonify({ResponseKey.ERROR.value: result}), 400
+
+    order_id = result
+
+    checkout_created, result = _get_checkout_session(order_id, cart.id, user_id, order_items)
 
     if not checkout_created:
+        db.session.rollback()
         return jsonify({ResponseKey.ERROR.value: result}), 400
 
     checkout_session_url = result.url
+    success, message = Order.set_checkout_session(
+        order_id, session_id=result.id, url=result.url, expires_at=datetime.utcfromtimestamp(result.expires_at),
+        commit=False
+    )
+    if not success:
+        return jsonify({ResponseKey.ERROR.value: message}), 500
+    db.session.commit()
 
     return jsonify(
         {
             ResponseKey.MESSAGE.value: "Order created successfully",
-            ResponseKey.ORDER_ID.value: order.id,
+            ResponseKey.ORDER_ID.value: order_id,
             ResponseKey.CHECKOUT_URL.value: checkout_session_url,
         }
     ), 201
 
 
-def _get_checkout_session(order):
+def _get_contents_hash(order_items) -> str:
+    contents = sorted((item['product_id'], item['quantity'], item['price'], item['currency']) for item in order_items)
+    return hashlib.sha256(json.dumps(contents, separators=(',', ':')).encode()).hexdigest()
+
+
+def _is_checkout_reusable(order, contents_hash) -> bool:
+    if order.contents_hash != contents_hash or not order.checkout_url or not order.checkout_expires_at:
+        return False
+    # Customer needs time to complete the payment before the session expires
+    return order.checkout_expires_at > datetime.utcnow() + _checkout_reuse_min_validity
+
+
+def _get_checkout_session(order_id, cart_id, user_id, order_items):
     items = []
 
-    for item in order.items:
-        product = get_cached_product_by_id(item.product_id)
+    for item in order_items:
+        product = get_cached_product_by_id(item['product_id'])
         if product:
             price_data = {
-                "currency": item.currency,
+                "currency": item['currency'],
                 "product_data": {
                     "name": product.name,
                     "description": product.description,
                     "images": product.images,
                 },
-                "unit_amount": int(item.price)
+                "unit_amount": item['price']
             }
             items.append({
                 "price_data": price_data,
-                "quantity": item.quantity
+                "quantity": item['quantity']
             })
         else:
-            print(f"Product with ID {item.product_id} not found in cache.")
+            print(f"Product with ID {item['product_id']} not found in cache.")
 
-    user = User.get_by_id(user_id=order.user_id)
+    user = User.get_by_id(user_id=user_id) if user_id else None
     customer_email = user.email if user else None
 
     return get_stripe_checkout_session(
-        order_id=order.id,
-        cart_id=order.cart_id,
+        order_id=order_id,
+        cart_id=cart_id,
         customer_email=customer_email,
         items=items
     )
@@ -168,7 +253,7 @@ def update_order_status_on_checkout_success():
     if not session_id:
         return jsonify({ResponseKey.ERROR.value: "session_id is required"}), 400
 
-    session_info = get_checkout_session_info(session_id)
+    session_info = get_cached_checkout_session_info(session_id)
     if session_info.session.payment_status != 'paid':
         return jsonify({ResponseKey.ERROR.value: "Payment not completed"}), 400
 
@@ -182,7 +267,7 @@ def update_order_status_on_checkout_success():
 
     if order.status == OrderStatus.PAID.value:
         if not order.notification_sent:
-            _send_order_confirmation_email_and_set_flag(order_id, session_info)
+            _enqueue_order_confirmation_emails(order_id, session_info)
         return jsonify({ResponseKey.MESSAGE.value: "Order already marked as PAID", "order_id": order_id}), 200
 
     order.update_order_status(order_id, OrderStatus.PAID.value)
@@ -192,7 +277,7 @@ def update_order_status_on_checkout_success():
         Cart.delete_cart(cart_id=cart_id)
 
     if not order.notification_sent:
-        _send_order_confirmation_email_and_set_flag(order_id, session_info)
+        _enqueue_order_confirmation_emails(order_id, session_info)
 
     return jsonify({ResponseKey.MESSAGE.value: "Order completed successfully", "order_id": order_id}), 200
 
@@ -232,22 +317,47 @@ def paid_order_status_stripe_webhook():
     if not valid_event:
         return jsonify({"error": event}), 400
 
+    if not is_stripe_catalog_event(event) and event['type'] != 'checkout.session.completed':
+        return jsonify({"message": "Event received"}), 200
+
+    # Event is acknowledged once stored, workers of the webhook inbox process it
+    try:
+        stored = WebhookEvent.store_event(event['id'], event['type'], payload, get_ordering_key(event))
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        print(f"Failed to store webhook event {event['id']}: {e}")
+        return jsonify({"error": "Failed to store event"}), 500
+
+    notify_webhook_inbox()
+    return jsonify({"message": "Event received" if stored else "Event already received"}), 200
+
+
+def process_stripe_event(event):
+    """
+    Processes a stored webhook event, called by webhook inbox workers.
+    """
+    if is_stripe_catalog_event(event):
+        apply_stripe_catalog_event(event)
+        return
+
     if event['type'] == 'checkout.session.completed':
-        session_info = get_checkout_session_info(event['data']['object']['id'])
+        # Event carries the full session, so it is not retrieved from Stripe again
+        session_info = get_checkout_session_info_from_session(event['data']['object'])
+        cache_checkout_session_info(session_info)
 
         if session_info.session.payment_status == 'paid':
             order_id = session_info.session.metadata.get('order_id')
             if not order_id:
-                return jsonify({"error": "Order ID not found in session metadata"}), 400
+                raise PermanentWebhookError("Order ID not found in session metadata")
 
             success, order = Order.get_order(order_id=order_id)
             if not success:
-                return jsonify({"error": "Order not found"}), 404
+                raise PermanentWebhookError(f"Order {order_id} not found")
 
             if order.status == OrderStatus.PAID.value:
                 if not order.notification_sent:
-                    _send_order_confirmation_email_and_set_flag(order_id, session_info)
-                return jsonify({ResponseKey.MESSAGE.value: "Order already marked as PAID"}), 200
+                    _enqueue_order_confirmation_emails(order_id, session_info)
+                return
 
             order.update_order_status(order_id, OrderStatus.PAID.value)
 
@@ -255,27 +365,24 @@ def paid_order_status_stripe_webhook():
             if cart_id:
                 Cart.delete_cart(cart_id=cart_id)
 
-            return jsonify({"message": "Order status updated to PAID"}), 200
 
-    return jsonify({"message": "Event received"}), 200
-
-
-def _send_order_confirmation_email_and_set_flag(
+def _enqueue_order_confirmation_emails(
         order_id: str,
         session_info: CheckoutSessionInfo
 ):
-    sent_to_customer = send_order_confirmation_email_to_customer(
-        recipient_email=session_info.email,
-        order_id=order_id,
-        first_name=session_info.first_name
-    )
-    sent_to_admin = send_order_confirmation_email_to_admin(
-        customer_email=session_info.email,
-        order_id=order_id,
-        first_name=session_info.first_name,
-        last_name=session_info.last_name,
-        payment_id=session_info.session.payment_intent,
-        shipping_address=session_info.session.shipping_address,
-    )
-    if sent_to_customer and sent_to_admin:
-        Order.flag_notification_sent(order_id)
+    # Enqueued once per order, the outbox workers flag the order as notified once both emails are sent
+    enqueue_emails([
+        get_order_confirmation_email_to_customer(
+            recipient_email=session_info.email,
+            order_id=order_id,
+            first_name=session_info.first_name
+        ),
+        get_order_confirmation_email_to_admin(
+            customer_email=session_info.email,
+            order_id=order_id,
+            first_name=session_info.first_name,
+            last_name=session_info.last_name,
+            payment_id=session_info.session.payment_intent,
+            shipping_address=session_info.session.shipping_address,
+        )
+    ])
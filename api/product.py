@@ -1,21 +1,36 @@
-from dataclasses import dataclass, field
+import bisect
+import hashlib
+from dataclasses import dataclass, field, asdict, fields as dataclass_fields
 from typing import Optional, List
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response, current_app
 
-from payment.stripe_product import StripeProduct, get_all_product_category_ids, get_stripe_products
-from utils.common import safe_int
+from payment.stripe_product import StripeProduct, ProductIndex, PRODUCT_SORT_FIELDS, get_product_index, \
+    get_product_sort_key
+from utils.common import safe_int, encode_cursor, decode_cursor
 from utils.constants import ResponseKey
 from utils.limiter import limiter
 
 product_blueprint = Blueprint('product', __name__)
 
 
+# Serialized responses are cached per catalog version, so clients may revalidate them this often
+_products_max_age = 60
+# Max number of products in a single page
+_max_page_size = 100
+_default_search_page_size = 20
+
+
 @product_blueprint.route('/products/categories', methods=['GET'])
 @limiter.limit("400/minute")
 def get_product_categories():
-    categories = get_all_product_category_ids()
-    return jsonify({ResponseKey.MESSAGE.value: "Categories successfully retrieved.", "categories": categories}), 200
+    return _get_cached_response(
+        key=('categories',),
+        build=lambda product_index: {
+            ResponseKey.MESSAGE.value: "Categories successfully retrieved.",
+            "categories": list(product_index.category_ids)
+        }
+    )
 
 
 @product_blueprint.route('/products', methods=['GET'])
@@ -23,29 +38,156 @@ def get_product_categories():
 def get_products():
     category_id = request.args.get('category_id')
     featured = request.args.get('featured') == 'true'
+    in_stock = request.args.get('in_stock') == 'true'
     product_ids = request.args.getlist('id')
-
-    all_products = get_stripe_products()
-
-    filtered_products = []
+    sort = request.args.get('sort')
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    fields = request.args.get('fields')
+
+    sort_field = sort.lstrip('-') if sort else None
+    if sort_field and sort_field not in PRODUCT_SORT_FIELDS:
+        return jsonify(
+            {ResponseKey.ERROR.value: f"Invalid sort, must be one of: {', '.join(PRODUCT_SORT_FIELDS)}"}
+        ), 400
+
+    page_size = safe_int(limit) if limit is not None else None
+    if limit is not None and (page_size is None or not 0 < page_size <= _max_page_size):
+        return jsonify({ResponseKey.ERROR.value: f"Invalid limit, must be between 1 and {_max_page_size}"}), 400
+
+    cursor_key = None
+    if cursor:
+        decoded_cursor = decode_cursor(cursor)
+        if not isinstance(decoded_cursor, dict) or decoded_cursor.get('sort') != sort \
+                or not isinstance(decoded_cursor.get('key'), list):
+            return jsonify({ResponseKey.ERROR.value: "Invalid cursor"}), 400
+        cursor_key = tuple(decoded_cursor['key'])
+
+    projection = None
+    if fields:
+        projection = {name.strip() for name in fields.split(',') if name.strip()}
+        product_fields = {product_field.name for product_field in dataclass_fields(Product)}
+        if not projection <= product_fields:
+            return jsonify(
+                {ResponseKey.ERROR.value: f"Invalid fields, must be any of: {', '.join(sorted(product_fields))}"}
+            ), 400
+
+    product_index = get_product_index()
+    is_paged = bool(sort or limit or cursor or fields)
+
+    view_key = None
     if product_ids:
-        filtered_products = [map_stripe_to_product(product) for product in all_products if product.id in product_ids]
+        products = tuple(product_index.get_by_ids(product_ids))
     else:
-        for product in all_products:
-            if category_id and safe_int(product.metadata.get('category_id')) != safe_int(category_id):
-                continue
-
-            if featured and product.metadata.get('featured') != 'true':
-                continue
-
-            filtered_products.append(map_stripe_to_product(product))
-
-    return jsonify(
-        {
-            ResponseKey.MESSAGE.value: "Products successfully retrieved.",
-            "products": filtered_products
-        }
-    ), 200
+        category_key = safe_int(category_id) if category_id else None
+        if category_id and category_key not in product_index.by_category_id:
+            products = ()
+        elif not is_paged:
+            return _get_cached_response(
+                key=('products', bool(category_id), category_key, featured, in_stock),
+                build=lambda index: _get_products_response(
+                    index.filter(category_id=category_id, featured=featured, in_stock=in_stock)
+                )
+            )
+        else:
+            view_key = (bool(category_id), category_key, featured, in_stock)
+            products = product_index.filter(category_id=category_id, featured=featured, in_stock=in_stock)
+
+    if not is_paged:
+        return jsonify(_get_products_response(products)), 200
+
+    try:
+        page, next_cursor_key = _get_page(
+            product_index, products, view_key, sort_field, sort != sort_field, cursor_key, page_size
+        )
+    except TypeError:
+        return jsonify({ResponseKey.ERROR.value: "Invalid cursor"}), 400
+
+    response = _get_products_response(page, projection)
+    if page_size:
+        response['next_cursor'] = encode_cursor({'sort': sort, 'key': next_cursor_key}) if next_cursor_key else None
+    return jsonify(response), 200
+
+
+@product_blueprint.route('/products/search', methods=['GET'])
+@limiter.limit("400/minute")
+def search_products():
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit')
+
+    if not query:
+        return jsonify({ResponseKey.ERROR.value: "q is required"}), 400
+
+    page_size = safe_int(limit) if limit is not None else _default_search_page_size
+    if page_size is None or not 0 < page_size <= _max_page_size:
+        return jsonify({ResponseKey.ERROR.value: f"Invalid limit, must be between 1 and {_max_page_size}"}), 400
+
+    products = get_product_index().search(query, limit=page_size)
+    return jsonify(_get_products_response(products)), 200
+
+
+def _get_page(product_index: ProductIndex, products, view_key, sort_field, descending, cursor_key, page_size):
+    """
+    Keyset pagination over products ordered by sort_field, or newest first when there is no sort field. Returns the
+    page and the sort key of its last product when more products follow. Filtered views identified by view_key are
+    sorted once per catalog version.
+    """
+    if not sort_field:
+        # Catalog positions are renumbered by every reload, so pages follow the stable (created, id) order instead
+        sort_field, descending = 'created', True
+
+    ordered = product_index.views.get(('sorted', view_key, sort_field)) if view_key else None
+    if ordered is None:
+        ordered = product_index.sort(products, sort_field)
+        if view_key:
+            product_index.views[('sorted', view_key, sort_field)] = ordered
+
+    def sort_key(product):
+        return get_product_sort_key(sort_field, product)
+
+    if not descending:
+        start = bisect.bisect_right(ordered, cursor_key, key=sort_key) if cursor_key else 0
+        end = len(ordered) if page_size is None else min(len(ordered), start + page_size)
+        page, has_more = ordered[start:end], end < len(ordered)
+    else:
+        end = bisect.bisect_left(ordered, cursor_key, key=sort_key) if cursor_key else len(ordered)
+        start = 0 if page_size is None else max(0, end - page_size)
+        page, has_more = ordered[start:end][::-1], start > 0
+
+    return page, list(sort_key(page[-1])) if page and has_more else None
+
+
+def _get_products_response(products, projection=None):
+    mapped_products = [map_stripe_to_product(product) for product in products]
+    if projection:
+        mapped_products = [
+            {key: value for key, value in asdict(product).items() if key in projection or key == 'id'}
+            for product in mapped_products
+        ]
+    return {
+        ResponseKey.MESSAGE.value: "Products successfully retrieved.",
+        "products": mapped_products
+    }
+
+
+def _get_cached_response(key, build) -> Response:
+    """
+    Serializes the response once per catalog version and serves it with a strong ETag, so unchanged catalog
+    is answered with 304 Not Modified.
+    """
+    product_index = get_product_index()
+    cached = product_index.views.get(key)
+    if cached is None:
+        body = current_app.json.response(build(product_index)).get_data()
+        cached = body, hashlib.sha256(body).hexdigest()
+        product_index.views[key] = cached
+
+    body, etag = cached
+    response = Response(body, status=200, mimetype=current_app.json.mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = _products_max_age
+    return response.make_conditional(request)
 
 
 @dataclass
@@ -1,7 +1,6 @@
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required, current_user
 
-from database.user import User
 from utils.constants import ResponseKey
 from utils.limiter import limiter
 
@@ -12,10 +11,9 @@ user_blueprint = Blueprint('user', __name__)
 @limiter.limit("200/minute")
 @jwt_required()
 def get_user_profile():
-    current_user_email = get_jwt_identity()
-    current_user = User.get_by_email(current_user_email)
-    if current_user:
-        return jsonify(current_user.to_dict()), 200
+    user = current_user.user
+    if user:
+        return jsonify(user.to_dict()), 200
     else:
         return jsonify({ResponseKey.ERROR.value: "User not found"}), 404
 
@@ -24,13 +22,11 @@ def get_user_profile():
 @limiter.limit("200/minute")
 @jwt_required()
 def update_user_profile():
-    current_user_email = get_jwt_identity()
-    current_user = User.get_by_email(current_user_email)
-
-    if not current_user:
+    user = current_user.user
+    if not user:
         return jsonify({ResponseKey.ERROR.value: "User not found"}), 404
 
-    if not current_user.active:
+    if not user.active:
         return jsonify({ResponseKey.ERROR.value: "User profile cannot be updated because the account is inactive"}), 403
 
     data = request.get_json()
@@ -40,9 +36,9 @@ def update_user_profile():
             {ResponseKey.ERROR.value: "Changes to activation status must be handled via the dedicated endpoints"}
         ), 403
 
-    success = current_user.update(data)
+    success = user.update(data)
     if success:
-        return jsonify({ResponseKey.MESSAGE.value: "User updated successfully", "user": current_user.to_dict()}), 200
+        return jsonify({ResponseKey.MESSAGE.value: "User updated successfully", "user": user.to_dict()}), 200
     else:
         return jsonify({ResponseKey.ERROR.value: "Failed to update user"}), 500
 
@@ -51,15 +47,14 @@ def update_user_profile():
 @limiter.limit("60/minute")
 @jwt_required()
 def deactivate_user():
-    current_user_email = get_jwt_identity()
-    current_user = User.get_by_email(current_user_email)
-    if not current_user:
+    user = current_user.user
+    if not user:
         return jsonify({ResponseKey.ERROR.value: "User not found"}), 404
 
-    if not current_user.active:
+    if not user.active:
         return jsonify({ResponseKey.MESSAGE.value: "User is already deactivated"}), 409
 
-    success = current_user.update({'active': False})
+    success = user.update({'active': False})
     if success:
         return jsonify({ResponseKey.MESSAGE.value: "User deactivated successfully"}), 200
     else:
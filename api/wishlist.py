@@ -1,9 +1,8 @@
 from dataclasses import dataclass
 
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required, current_user
 
-from database.user import User
 from database.wishlist import Wishlist
 from database.wishlist import WishlistItem as WishlistItemDB
 from utils.constants import ResponseKey
@@ -16,13 +15,7 @@ wishlist_blueprint = Blueprint('wishlist', __name__)
 @limiter.limit("100/minute")
 @jwt_required()
 def get_user_wishlist():
-    user_email = get_jwt_identity()
-    user = User.get_by_email(user_email)
-
-    if not user:
-        return jsonify({ResponseKey.ERROR.value: "User not found"}), 404
-
-    wishlist = Wishlist.get_wishlist(user_id=user.id)
+    wishlist = Wishlist.get_wishlist(user_id=current_user.id)
 
     if wishlist:
         return jsonify(
@@ -39,17 +32,11 @@ def get_user_wishlist():
 @limiter.limit("100/minute")
 @jwt_required()
 def add_item_to_wishlist():
-    user_email = get_jwt_identity()
-    user = User.get_by_email(user_email)
-
-    if not user:
-        return jsonify({ResponseKey.ERROR.value: "User not found"}), 404
-
     data = request.get_json()
     if not data:
         return jsonify({ResponseKey.ERROR.value: "Request data is required"}), 400
 
-    user_id = user.id
+    user_id = current_user.id
     product_id = data.get('product_id')
     if not product_id:
         return jsonify({ResponseKey.ERROR.value: "product_id is required"}), 400
@@ -62,17 +49,11 @@ def add_item_to_wishlist():
 @limiter.limit("100/minute")
 @jwt_required()
 def remove_item_from_wishlist():
-    user_email = get_jwt_identity()
-    user = User.get_by_email(user_email)
-
-    if not user:
-        return jsonify({ResponseKey.ERROR.value: "User not found"}), 404
-
     data = request.get_json()
     if not data:
         return jsonify({ResponseKey.ERROR.value: "Request data is required"}), 400
 
-    user_id = user.id
+    user_id = current_user.id
     product_id = data.get('product_id')
     if not product_id:
         return jsonify({ResponseKey.ERROR.value: "product_id is required"}), 400
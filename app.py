@@ -8,16 +8,26 @@ from flask_jwt_extended import JWTManager
 
 from api.auth import auth_blueprint
 from api.cart import cart_blueprint
-from api.order import order_blueprint
+from api.identity import initialize_identity
+from api.order import order_blueprint, process_stripe_event
 from api.product import product_blueprint
 from api.user import user_blueprint
 from api.wishlist import wishlist_blueprint
 from database import db
+from database.cart import initialize_guest_cart_purge
+from database.order import initialize_pending_order_reaper
 from notification.email_notification import initialize_email_notification_env_variables
+from notification.email_outbox import initialize_email_outbox
 from payment.stripe import initialize_stripe
-from payment.stripe_product import get_stripe_products
+from payment.stripe_checkout import expire_checkout_session
+from payment.stripe_product import initialize_product_cache
+from payment.webhook_inbox import initialize_webhook_inbox
 from utils.environment import Environment, get_environment_file
 from utils.limiter import limiter
+from utils.query_counter import initialize_query_counter
+from utils.timing import StartupTimer
+
+startup_timer = StartupTimer()
 
 # Determine if running remotely or locally
 is_remote = os.getenv('FLASK_REMOTE', 'false').lower() == 'true'
@@ -46,6 +56,7 @@ app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=1)
 app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=30)
 jwt = JWTManager(app)
+initialize_identity(jwt)
 
 # Register api
 app.register_blueprint(auth_blueprint)
@@ -58,20 +69,40 @@ app.register_blueprint(wishlist_blueprint)
 # Set database ORM
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('POSTGRES_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Merge guest cart into user cart in background instead of during sign-in
+app.config['CART_MERGE_DEFERRED'] = os.getenv('CART_MERGE_DEFERRED', 'false').lower() == 'true'
+
 db.init_app(app)
 
-with app.app_context():
+# Count SQL statements per request, optionally reported in X-SQL-Query-Count response header
+initialize_query_counter(app, expose_header=os.getenv('SQL_QUERY_COUNT_HEADER', 'false').lower() == 'true')
+
+with startup_timer.phase('database'), app.app_context():
     db.create_all()  # Created db tables if not exist
 
 # Initialize Stripe
 initialize_stripe()
-get_stripe_products()
+with startup_timer.phase('product catalog'):
+    product_catalog_source = initialize_product_cache()
 
 # Initialize request rate limiter
 limiter.init_app(app)
 
 # Notifications
 initialize_email_notification_env_variables()
+initialize_email_outbox(app)
+
+# Expired guest carts
+initialize_guest_cart_purge(app)
+
+# Abandoned checkouts
+initialize_pending_order_reaper(app, expire_checkout_session=expire_checkout_session)
+
+# Stripe webhook events stored by the webhook endpoint
+initialize_webhook_inbox(app, handler=process_stripe_event)
+
+print(f"{startup_timer.report()}, product catalog loaded from {product_catalog_source}")
 
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,94 @@
+"""
+Compares throughput and correctness of concurrent cart adds, using the previous read-modify-write implementation and
+the current single upsert. Every thread adds one item at a time to the same guest cart and product, which is the
+worst case for lost increments.
+
+Requires a migrated Postgres database, use a scratch one as benchmark carts are created and removed:
+
+    POSTGRES_URL=postgresql://localhost/marketplace_bench python -m benchmarks.cart_add_throughput [threads] [adds]
+"""
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+from sqlalchemy.exc import SQLAlchemyError
+
+from database import db
+from database.cart import Cart, CartItem
+# Imported so that all relations of Cart resolve
+from database import order, user, wishlist  # noqa: F401
+
+
+def _legacy_add_item_to_cart(product_id, quantity, guest_id):
+    cart = Cart.query.filter_by(guest_id=guest_id).first()
+
+    if not cart:
+        cart = Cart(guest_id=guest_id)
+        db.session.add(cart)
+
+    cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
+    if cart_item:
+        cart_item.quantity += quantity
+    else:
+        cart_item = CartItem(cart_id=cart.id, product_id=product_id, quantity=quantity)
+        db.session.add(cart_item)
+
+    db.session.commit()
+
+
+def _current_add_item_to_cart(product_id, quantity, guest_id):
+    Cart.add_item_to_cart(product_id=product_id, quantity=quantity, guest_id=guest_id)
+
+
+def _run(app, add, threads: int, adds: int):
+    guest_id = f'benchmark-{uuid.uuid4()}'
+    product_id = 'prod_benchmark'
+
+    def worker(_):
+        failed = 0
+        with app.app_context():
+            for _ in range(adds):
+                try:
+                    add(product_id, 1, guest_id)
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    failed += 1
+        return failed
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        failed = sum(executor.map(worker, range(threads)))
+    elapsed = time.perf_counter() - started_at
+
+    with app.app_context():
+        carts = Cart.query.filter_by(guest_id=guest_id).all()
+        quantity = sum(item.quantity for cart in carts for item in cart.items)
+        for cart in carts:
+            db.session.delete(cart)
+        db.session.commit()
+
+    total = threads * adds
+    return total / elapsed, failed, total - failed - quantity, len(carts)
+
+
+def main(threads: int, adds: int):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['POSTGRES_URL']
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': threads}
+    db.init_app(app)
+
+    print(f"Threads: {threads}, adds per thread: {adds}")
+    for name, add in [('read-modify-write', _legacy_add_item_to_cart), ('upsert', _current_add_item_to_cart)]:
+        throughput, failed, lost, carts = _run(app, add, threads, adds)
+        print(f"{name}: {throughput:.0f} adds/s, {failed} failed, {lost} lost increments, {carts} carts")
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    )
@@ -0,0 +1,89 @@
+"""
+Reports memory retained by the cached product catalog, per product.
+
+Run from the project root:
+
+    python -m benchmarks.catalog_memory [number_of_products]
+"""
+import gc
+import json
+import random
+import sys
+import tracemalloc
+
+from payment.stripe_product import ProductIndex, _map_stripe_price, _map_stripe_product
+
+
+def _make_stripe_products_json(count: int) -> str:
+    words = ['čaša', 'šalica', 'tanjur', 'vaza', 'keramika', 'drvo', 'ručno', 'izrađen', 'plava', 'bijela', 'lonac']
+    products = []
+    for i in range(count):
+        products.append({
+            'id': f'prod_{i:014d}',
+            'object': 'product',
+            'active': True,
+            'created': 1717000000 + i,
+            'default_price': {
+                'id': f'price_{i:024d}',
+                'object': 'price',
+                'currency': 'eur',
+                'unit_amount': random.randint(100, 100000),
+            },
+            'description': ' '.join(random.choices(words, k=25)),
+            'images': [f'https://files.stripe.com/links/{i:040d}'],
+            'features': [],
+            'livemode': False,
+            'marketing_features': [],
+            'metadata': {
+                'category_id': str(i % 12),
+                'featured': random.choice(['true', 'false']),
+                'in_stock': random.choice(['true', 'false']),
+                'discount': str(random.choice([0, 10, 20])),
+            },
+            'name': ' '.join(random.choices(words, k=3)),
+            'package_dimensions': None,
+            'shippable': None,
+            'statement_descriptor': None,
+            'tax_code': None,
+            'unit_label': None,
+            'type': 'service',
+            'updated': 1718000000 + i,
+            'url': None,
+        })
+    return json.dumps(products)
+
+
+def _measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained
+
+
+def main(count: int):
+    random.seed(0)
+    products_json = _make_stripe_products_json(count)
+
+    def build_products():
+        # Stripe response is parsed inside the measurement, so that retained strings are counted, then dropped
+        return [_map_stripe_product(data, _map_stripe_price(data['default_price'])) for data in json.loads(products_json)]
+
+    def build_index():
+        return ProductIndex.build(build_products())
+
+    products_size = _measure(build_products)
+    index_size = _measure(build_index)
+
+    print(f"Products: {count}")
+    print(f"Catalog objects: {products_size / count:.0f} bytes per product ({products_size / 1024 / 1024:.1f} MiB)")
+    print(f"Catalog with indexes: {index_size / count:.0f} bytes per product ({index_size / 1024 / 1024:.1f} MiB)")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -1,28 +1,86 @@
-from sqlalchemy import Column, Integer, ForeignKey, DateTime, String
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import relationship
+import enum
+import os
+import time
+from datetime import timedelta
+
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, String, Boolean, UniqueConstraint, select, update, \
+    insert, delete, exists, literal, literal_column, cast, case, union_all, values, column, true
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError, OperationalError
+from sqlalchemy.orm import relationship, joinedload
 
 from database import db
+from database.order import Order
+from utils.scheduler import run_periodically
+
+
+# Postgres error code of a lock that was not granted within lock_timeout
+_lock_not_available = '55P03'
+
+
+class CartOperation(enum.Enum):
+    ADD = 'add'
+    REMOVE = 'remove'
+    SET = 'set'
 
 
 class Cart(db.Model):
     id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, server_default=db.func.current_timestamp())
-    updated_at = Column(DateTime, server_default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
+    updated_at = Column(DateTime, server_default=db.func.current_timestamp(), onupdate=db.func.current_timestamp(),
+                        index=True)
     user_id = Column(Integer, ForeignKey('user.id'), nullable=True)
-    guest_id = Column(String, nullable=True)
+    guest_id = Column(String, nullable=True, index=True)
 
     # Relations
     order = relationship('Order', uselist=True, back_populates='cart')
-    items = relationship('CartItem', back_populates='cart', cascade="all, delete-orphan")
+    items = relationship('CartItem', back_populates='cart', cascade="all, delete-orphan", order_by='CartItem.id')
+
+    @classmethod
+    def get_cart_by_user_id(cls, user_id=None, guest_id=None, with_items=False):
+        # Oldest cart of the owner, the same one add_item_to_cart adds to
+        if user_id:
+            query = Cart.query.filter_by(user_id=user_id)
+        elif guest_id:
+            query = Cart.query.filter_by(guest_id=guest_id)
+        else:
+            return None
+        if with_items:
+            query = query.options(joinedload(Cart.items))
+        return query.order_by(Cart.id).first()
 
     @classmethod
-    def get_cart_by_user_id(cls, user_id=None, guest_id=None):
+    def lock_cart_for_checkout(cls, user_id=None, guest_id=None, lock_timeout=timedelta(seconds=10)):
+        """
+        Locks the owner's cart until the end of the transaction and loads it with items. Returns (True, cart or None),
+        or (False, error message) when the lock was not granted within lock_timeout.
+        """
         if user_id:
-            return Cart.query.filter_by(user_id=user_id).first()
+            owner_filter = Cart.user_id == user_id
         elif guest_id:
-            return Cart.query.filter_by(guest_id=guest_id).first()
-        return None
+            owner_filter = Cart.guest_id == guest_id
+        else:
+            return True, None
+
+        session = db.session
+        try:
+            # Limited to this transaction, a lock that is not granted in time raises instead of queueing requests
+            session.execute(
+                select(db.func.set_config('lock_timeout', f'{int(lock_timeout.total_seconds() * 1000)}ms', True))
+            )
+            cart_id = session.execute(
+                select(Cart.id).where(owner_filter).order_by(Cart.id).limit(1).with_for_update()
+            ).scalar()
+        except OperationalError as e:
+            session.rollback()
+            if getattr(e.orig, 'pgcode', None) != _lock_not_available:
+                raise
+            return False, "Checkout of this cart is already in progress"
+        if cart_id is None:
+            return True, None
+
+        # Loaded after the lock is granted, so that changes committed by the previous lock holder are seen
+        return True, Cart.query.options(joinedload(Cart.items)).filter_by(id=cart_id).first()
 
     @classmethod
     def get_cart_by_id(cls, cart_id):
@@ -34,20 +92,116 @@ class Cart(db.Model):
 
     @classmethod
     def add_item_to_cart(cls, product_id, quantity, user_id=None, guest_id=None):
-        cart = cls.get_cart_by_user_id(user_id, guest_id)
+        """
+        Adds quantity of the product to the owner's cart, created when missing, with a single upsert.
+        """
+        cls._lock_owner_carts(user_id, guest_id)
+        cart_id = cls._get_or_create_owner_cart_id(user_id, guest_id)
+
+        statement = pg_insert(CartItem).from_select(
+            [CartItem.cart_id, CartItem.product_id, CartItem.quantity],
+            select(cart_id.c.id, cast(literal(product_id), String), cast(literal(quantity), Integer))
+        )
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[CartItem.cart_id, CartItem.product_id],
+            set_={'quantity': CartItem.quantity + statement.excluded.quantity}
+        ))
+        db.session.commit()
 
-        if not cart:
-            cart = Cart(user_id=user_id, guest_id=guest_id)
-            db.session.add(cart)
+    @classmethod
+    def apply_cart_operations(cls, operations, user_id=None, guest_id=None):
+        """
+        Applies (operation, product_id, quantity) tuples to the owner's cart in one transaction. Returns the cart, or
+        None when a batch of only removals finds no cart.
+        """
+        # Reduced product quantity, set quantities replace the cart quantity and the others are added to it
+        quantities = {}
+        for operation, product_id, quantity in operations:
+            current, is_set = quantities.get(product_id, (0, False))
+            if operation == CartOperation.SET:
+                quantities[product_id] = (quantity, True)
+            elif operation == CartOperation.ADD:
+                quantities[product_id] = (current + quantity, is_set)
+            else:
+                quantities[product_id] = (current - quantity, is_set)
 
-        cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
-        if cart_item:
-            cart_item.quantity += quantity
-        else:
-            cart_item = CartItem(cart_id=cart.id, product_id=product_id, quantity=quantity)
-            db.session.add(cart_item)
+        session = db.session
+        try:
+            cls._lock_owner_carts(user_id, guest_id)
+            # Removals alone never create a cart
+            create = any(operation != CartOperation.REMOVE for operation, _, _ in operations)
+            cart_id = cls._get_or_create_owner_cart_id(user_id, guest_id, create=create)
+
+            changes = (
+                select(
+                    values(
+                        column('product_id', String), column('quantity', Integer), column('is_set', Boolean),
+                        name='changes'
+                    ).data([(product_id, quantity, is_set) for product_id, (quantity, is_set) in quantities.items()])
+                )
+                .cte('changes')
+            )
+            statement = pg_insert(CartItem).from_select(
+                [CartItem.cart_id, CartItem.product_id, CartItem.quantity],
+                select(cart_id.c.id, changes.c.product_id, changes.c.quantity)
+                .select_from(cart_id.join(changes, true()))
+            )
+            # Referenced by name, as the conflicting row is not a FROM clause the subquery could correlate with
+            is_set = select(changes.c.is_set).where(
+                changes.c.product_id == literal_column('excluded.product_id')
+            ).scalar_subquery()
+            statement = statement.on_conflict_do_update(
+                index_elements=[CartItem.cart_id, CartItem.product_id],
+                set_={'quantity': case((is_set, statement.excluded.quantity),
+                                       else_=CartItem.quantity + statement.excluded.quantity)}
+            ).returning(CartItem.cart_id)
+            owner_cart_id = session.execute(statement).scalars().first()
+            if owner_cart_id is None:
+                session.rollback()
+                return True, None
+
+            session.execute(delete(CartItem).where(CartItem.cart_id == owner_cart_id, CartItem.quantity <= 0))
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            return False, "Database error during cart update"
 
-        db.session.commit()
+        return True, cls.query.options(joinedload(cls.items)).filter_by(id=owner_cart_id).first()
+
+    @classmethod
+    def _lock_owner_carts(cls, user_id=None, guest_id=None):
+        # Serializes cart changes of the same owner until commit, so that two first changes cannot both create a cart
+        owner_key = f'cart:user:{user_id}' if user_id else f'cart:guest:{guest_id}'
+        db.session.execute(select(db.func.pg_advisory_xact_lock(db.func.hashtext(owner_key))))
+
+    @classmethod
+    def _get_or_create_owner_cart_id(cls, user_id=None, guest_id=None, create=True):
+        # Id of the owner's oldest cart, touched, or of a new cart when the owner has none and create is set
+        user_id = int(user_id) if user_id else None
+        owner = Cart.user_id == user_id if user_id else Cart.guest_id == guest_id
+
+        owner_cart_id = select(Cart.id).where(owner).order_by(Cart.id).limit(1).scalar_subquery()
+        existing_cart = (
+            update(Cart)
+            .where(Cart.id == owner_cart_id)
+            .values(updated_at=db.func.current_timestamp())
+            .returning(Cart.id)
+            .cte('existing_cart')
+        )
+        if not create:
+            return select(existing_cart.c.id).subquery('cart_id')
+
+        new_cart = (
+            insert(Cart)
+            .from_select(
+                [Cart.user_id, Cart.guest_id],
+                select(cast(literal(user_id), Integer), cast(literal(guest_id), String))
+                .where(~exists(select(existing_cart.c.id)))
+            )
+            .returning(Cart.id)
+            .cte('new_cart')
+        )
+        return union_all(select(existing_cart.c.id), select(new_cart.c.id)).subquery('cart_id')
 
     @classmethod
     def remove_item_from_cart(cls, product_id, quantity, user_id=None, guest_id=None):
@@ -70,34 +224,47 @@ class Cart(db.Model):
 
     @classmethod
     def merge_carts(cls, guest_id, user_id):
+        """
+        Moves items of the guest carts into the user cart, created when missing, and deletes the guest carts.
+        """
         session = db.session
 
         try:
-            guest_cart = Cart.query.filter_by(guest_id=guest_id).first()
-            if not guest_cart:
+            cls._lock_owner_carts(user_id=user_id)
+            cls._lock_owner_carts(guest_id=guest_id)
+
+            guest_cart_ids = select(Cart.id).where(Cart.guest_id == guest_id)
+            user_cart_id = cls._get_or_create_owner_cart_id(user_id=user_id)
+            guest_items = (
+                select(CartItem.product_id, db.func.sum(CartItem.quantity).label('quantity'))
+                .where(CartItem.cart_id.in_(guest_cart_ids))
+                .group_by(CartItem.product_id)
+                .subquery('guest_items')
+            )
+            statement = pg_insert(CartItem).from_select(
+                [CartItem.cart_id, CartItem.product_id, CartItem.quantity],
+                select(user_cart_id.c.id, guest_items.c.product_id, guest_items.c.quantity)
+                .select_from(user_cart_id.join(guest_items, true()))
+            )
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[CartItem.cart_id, CartItem.product_id],
+                set_={'quantity': CartItem.quantity + statement.excluded.quantity}
+            ))
+
+            # Orders keep their items, only the reference to the deleted guest cart is cleared
+            # Guest carts are not loaded into the session, so there is nothing to synchronize
+            options = {'synchronize_session': False}
+            session.execute(
+                update(Order).where(Order.cart_id.in_(guest_cart_ids)).values(cart_id=None), execution_options=options
+            )
+            session.execute(delete(CartItem).where(CartItem.cart_id.in_(guest_cart_ids)), execution_options=options)
+            deleted_carts = session.execute(
+                delete(Cart).where(Cart.guest_id == guest_id), execution_options=options
+            ).rowcount
+            if not deleted_carts:
+                session.rollback()
                 return "Unable to merge carts as no guest cart found"
 
-            user_cart = Cart.query.filter_by(user_id=user_id).first()
-
-            if not user_cart:
-                user_cart = Cart(user_id=user_id)
-                session.add(user_cart)
-                session.commit()
-
-            for guest_item in guest_cart.items:
-                user_item = CartItem.query.filter_by(cart_id=user_cart.id, product_id=guest_item.product_id).first()
-
-                if user_item:
-                    user_item.quantity += guest_item.quantity
-                else:
-                    new_item = CartItem(
-                        cart_id=user_cart.id,
-                        product_id=guest_item.product_id,
-                        quantity=guest_item.quantity
-                    )
-                    session.add(new_item)
-
-            session.delete(guest_cart)
             session.commit()
             return "Cart merged successfully"
 
@@ -109,6 +276,49 @@ class Cart(db.Model):
             session.rollback()
             return "Unexpected error during merging carts"
 
+    @classmethod
+    def purge_expired_guest_carts(cls, ttl: timedelta, chunk_size=1000):
+        """
+        Deletes guest carts not updated for longer than ttl in chunks. Returns number of purged carts and items.
+        """
+        session = db.session
+        options = {'synchronize_session': False}
+        purged_carts = purged_items = 0
+        expired_before = db.func.current_timestamp() - ttl
+
+        try:
+            while True:
+                cart_ids = session.execute(
+                    select(Cart.id)
+                    .where(Cart.user_id.is_(None), Cart.guest_id.isnot(None), Cart.updated_at < expired_before)
+                    .order_by(Cart.updated_at)
+                    .limit(chunk_size)
+                    .with_for_update(skip_locked=True)
+                ).scalars().all()
+                if not cart_ids:
+                    session.commit()
+                    break
+
+                session.execute(
+                    update(Order).where(Order.cart_id.in_(cart_ids)).values(cart_id=None), execution_options=options
+                )
+                purged_items += session.execute(
+                    delete(CartItem).where(CartItem.cart_id.in_(cart_ids)), execution_options=options
+                ).rowcount
+                purged_carts += session.execute(
+                    delete(Cart).where(Cart.id.in_(cart_ids)), execution_options=options
+                ).rowcount
+                session.commit()
+
+                if len(cart_ids) < chunk_size:
+                    break
+
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Database error during guest cart purge: {e}")
+
+        return purged_carts, purged_items
+
     @classmethod
     def delete_cart(cls, cart_id):
         session = db.session
@@ -138,6 +348,8 @@ class Cart(db.Model):
 
 
 class CartItem(db.Model):
+    __table_args__ = (UniqueConstraint('cart_id', 'product_id', name='uq_cart_item_cart_id_product_id'),)
+
     id = Column(Integer, primary_key=True)
     cart_id = Column(Integer, ForeignKey('cart.id'), nullable=False)
     product_id = Column(String, nullable=False)
@@ -153,3 +365,33 @@ class CartItem(db.Model):
             "product_id": self.product_id,
             "quantity": self.quantity,
         }
+
+
+# Guest carts not changed for this many days are purged, 0 disables the purge
+_guest_cart_ttl_days = 30
+# Seconds between guest cart purges
+_guest_cart_purge_interval = 3600
+_guest_cart_purge_chunk_size = 1000
+
+
+def initialize_guest_cart_purge(app):
+    global _guest_cart_ttl_days, _guest_cart_purge_interval
+    _guest_cart_ttl_days = int(os.getenv('GUEST_CART_TTL_DAYS', _guest_cart_ttl_days))
+    _guest_cart_purge_interval = int(os.getenv('GUEST_CART_PURGE_INTERVAL', _guest_cart_purge_interval))
+    if _guest_cart_ttl_days <= 0 or _guest_cart_purge_interval <= 0:
+        return
+
+    def purge():
+        with app.app_context():
+            purge_expired_guest_carts()
+
+    run_periodically('guest-cart-purge', _guest_cart_purge_interval, purge)
+
+
+def purge_expired_guest_carts():
+    started = time.perf_counter()
+    carts, items = Cart.purge_expired_guest_carts(
+        timedelta(days=_guest_cart_ttl_days), chunk_size=_guest_cart_purge_chunk_size
+    )
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"Purged {carts} expired guest carts and {items} cart items in {elapsed:.1f} ms")
@@ -0,0 +1,133 @@
+import enum
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, String, Text, Integer, DateTime, Boolean, ForeignKey, Index, select, update, exists, \
+    case, false
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database import db
+from database.lease_queue import LeaseQueue
+from database.order import Order
+
+
+class EmailStatus(enum.Enum):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+
+class EmailOutbox(LeaseQueue, db.Model):
+    """
+    Outbox of emails, enqueued by requests and sent by background workers. Timestamps are UTC.
+    """
+    pending_status = EmailStatus.PENDING.value
+    leased_status = EmailStatus.SENDING.value
+    finished_status = EmailStatus.SENT.value
+    failed_status = EmailStatus.FAILED.value
+    finished_at_column = 'sent_at'
+
+    __table_args__ = (
+        Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    # Email with the same dedupe key is enqueued only once, e.g. confirmation of an order
+    dedupe_key = Column(String, nullable=True, unique=True)
+    # Order is flagged as notified once all of its emails are sent
+    order_id = Column(Integer, ForeignKey('order.id'), nullable=True, index=True)
+    recipients = Column(Text, nullable=False)  # Comma separated
+    subject = Column(String, nullable=False)
+    body = Column(Text, nullable=False)  # HTML
+    # Body holds a secret, e.g. a password reset link, and is blanked once the email is sent or given up
+    sensitive = Column(Boolean, nullable=False, default=False, server_default=false())
+    status = Column(String, nullable=False, default=EmailStatus.PENDING.value)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    # End of the lease of the worker sending the email
+    locked_until = Column(DateTime, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def enqueue(cls, emails):
+        """
+        Enqueues emails given as dicts of columns, skipping already enqueued dedupe keys. Returns number enqueued.
+        """
+        now = datetime.utcnow()
+        session = db.session
+        try:
+            result = session.execute(
+                pg_insert(EmailOutbox)
+                .values([
+                    {
+                        'dedupe_key': email.get('dedupe_key'),
+                        'order_id': email.get('order_id'),
+                        'recipients': email['recipients'],
+                        'subject': email['subject'],
+                        'body': email['body'],
+                        'sensitive': email.get('sensitive', False),
+                        'status': EmailStatus.PENDING.value,
+                        'attempts': 0,
+                        'created_at': now,
+                        'next_attempt_at': now
+                    }
+                    for email in emails
+                ])
+                .on_conflict_do_nothing(index_elements=[EmailOutbox.dedupe_key])
+            )
+            session.commit()
+            return result.rowcount
+        except Exception:
+            session.rollback()
+            raise
+
+    @classmethod
+    def claim_emails(cls, limit, lease: timedelta):
+        return cls._claim(
+            limit, lease,
+            returning=(EmailOutbox.id, EmailOutbox.order_id, EmailOutbox.recipients, EmailOutbox.subject,
+                       EmailOutbox.body, EmailOutbox.created_at, EmailOutbox.attempts),
+            order_by=EmailOutbox.next_attempt_at
+        )
+
+    @classmethod
+    def mark_sent(cls, email_id, order_id=None):
+        """
+        Marks the email as sent, and its order as notified once all of the order's emails are sent.
+        """
+        session = db.session
+        options = {'synchronize_session': False}
+        try:
+            session.execute(
+                update(EmailOutbox)
+                .where(EmailOutbox.id == email_id)
+                .values(status=EmailStatus.SENT.value, sent_at=datetime.utcnow(), locked_until=None, last_error=None,
+                        body=cls._get_retained_body()),
+                execution_options=options
+            )
+            if order_id:
+                # Workers sending the other emails of the order wait for this lock, so the last of them to commit
+                # sees every email sent
+                session.execute(select(Order.id).where(Order.id == order_id).with_for_update())
+                is_unsent = exists().where(
+                    EmailOutbox.order_id == order_id, EmailOutbox.status != EmailStatus.SENT.value
+                )
+                session.execute(
+                    update(Order).where(Order.id == order_id, ~is_unsent).values(notification_sent=True),
+                    execution_options=options
+                )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    @classmethod
+    def mark_failed(cls, email_id, error):
+        cls._update(email_id, status=EmailStatus.FAILED.value, locked_until=None, last_error=error,
+                    body=cls._get_retained_body())
+
+    @classmethod
+    def _get_retained_body(cls):
+        return case((EmailOutbox.sensitive, ''), else_=EmailOutbox.body)
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, or_, and_
+
+from database import db
+
+
+class LeaseQueue:
+    """
+    Mixin of a queue model whose rows are leased by background workers, and claimed again once the lease ran out.
+    """
+    pending_status: str
+    leased_status: str
+    finished_status: str
+    failed_status: str
+    finished_at_column: str
+
+    @classmethod
+    def _claim(cls, limit, lease: timedelta, returning, order_by, criteria=()):
+        now = datetime.utcnow()
+        is_due = or_(
+            and_(cls.status == cls.pending_status, cls.next_attempt_at <= now),
+            and_(cls.status == cls.leased_status, cls.locked_until < now)
+        )
+        claimable_ids = (
+            select(cls.id)
+            .where(is_due, *criteria)
+            .order_by(order_by)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+
+        session = db.session
+        try:
+            rows = session.execute(
+                update(cls)
+                .where(cls.id.in_(claimable_ids.scalar_subquery()))
+                .values(status=cls.leased_status, locked_until=now + lease, attempts=cls.attempts + 1)
+                .returning(*returning),
+                execution_options={'synchronize_session': False}
+            ).all()
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return rows
+
+    @classmethod
+    def schedule_retry(cls, row_id, error, next_attempt_at):
+        cls._update(row_id, status=cls.pending_status, next_attempt_at=next_attempt_at, locked_until=None,
+                    last_error=error)
+
+    @classmethod
+    def mark_failed(cls, row_id, error):
+        cls._update(row_id, status=cls.failed_status, locked_until=None, last_error=error)
+
+    @classmethod
+    def _update(cls, row_id, **values):
+        session = db.session
+        try:
+            session.execute(
+                update(cls).where(cls.id == row_id).values(**values),
+                execution_options={'synchronize_session': False}
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    @classmethod
+    def purge_finished(cls, finished_before):
+        finished_at = getattr(cls, cls.finished_at_column)
+        session = db.session
+        result = session.execute(
+            delete(cls).where(cls.status == cls.finished_status, finished_at < finished_before),
+            execution_options={'synchronize_session': False}
+        )
+        session.commit()
+        return result.rowcount
@@ -1,9 +1,16 @@
 import enum
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-from sqlalchemy import Column, Integer, ForeignKey, DateTime, String, Float, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, String, Float, Boolean, Index, select, update, insert, \
+    tuple_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import relationship, joinedload, selectinload
 
 from database import db
+from utils.scheduler import run_periodically
 
 
 class OrderStatus(enum.Enum):
@@ -13,8 +20,15 @@ class OrderStatus(enum.Enum):
 
 
 class Order(db.Model):
+    # Order history is listed newest first per user or guest, optionally filtered by status
+    __table_args__ = (
+        Index('ix_order_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+        Index('ix_order_guest_id_created_at_id', 'guest_id', 'created_at', 'id'),
+        Index('ix_order_status_created_at', 'status', 'created_at'),
+    )
+
     id = Column(Integer, primary_key=True)
-    cart_id = Column(Integer, ForeignKey('cart.id'), nullable=True, unique=False)
+    cart_id = Column(Integer, ForeignKey('cart.id'), nullable=True, unique=False, index=True)
     created_at = Column(DateTime, server_default=db.func.current_timestamp())
     updated_at = Column(DateTime, server_default=db.func.current_timestamp(), onupdate=db.func.current_timestamp())
     user_id = Column(Integer, ForeignKey('user.id'), nullable=True)
@@ -22,13 +36,18 @@ class Order(db.Model):
     total_amount = Column(Float, nullable=False, default=0.0)  # In cents
     status = Column(String, nullable=False, default=OrderStatus.PENDING.value)
     notification_sent = Column(Boolean, nullable=False, default=False)
+    # Checkout of a pending order is reused while the cart contents, hashed with prices, stay the same
+    contents_hash = Column(String(64), nullable=True)
+    checkout_session_id = Column(String, nullable=True)
+    checkout_url = Column(String, nullable=True)
+    checkout_expires_at = Column(DateTime, nullable=True)  # UTC
 
     # Relations
     cart = relationship('Cart', back_populates='order')
-    items = relationship('OrderItem', back_populates='order', cascade="all, delete-orphan")
+    items = relationship('OrderItem', back_populates='order', cascade="all, delete-orphan", order_by='OrderItem.id')
 
     @classmethod
-    def get_order(cls, order_id, user_id=None, guest_id=None):
+    def get_order(cls, order_id, user_id=None, guest_id=None, with_items=False):
         query = Order.query.filter_by(id=order_id)
 
         if user_id:
@@ -36,31 +55,81 @@ class Order(db.Model):
         elif guest_id:
             query = query.filter_by(guest_id=guest_id)
 
-        if query.count() == 0:
+        if with_items:
+            # Items are loaded by the same query
+            query = query.options(joinedload(Order.items))
+
+        order = query.first()
+        if not order:
             return False, "Order does not exist"
-        return True, query.first()
+        return True, order
+
+    @classmethod
+    def get_orders(cls, user_id=None, guest_id=None, status=None, after=None, limit=20):
+        """
+        Returns a page of the owner's orders, newest first, with items loaded by one additional query for the whole
+        page. after is the (created_at, id) of the last order of the previous page. One more order than limit is
+        returned when there is a next page.
+        """
+        query = Order.query.filter_by(user_id=user_id) if user_id else Order.query.filter_by(guest_id=guest_id)
+        if status:
+            query = query.filter_by(status=status)
+        if after:
+            query = query.filter(tuple_(Order.created_at, Order.id) < tuple_(*after))
+
+        return (
+            query.options(selectinload(Order.items))
+            .order_by(Order.created_at.desc(), Order.id.desc())
+            .limit(limit + 1)
+            .all()
+        )
 
     @classmethod
-    def create_order(cls, cart_id, user_id=None, guest_id=None):
+    def create_order(cls, cart_id, items, user_id=None, guest_id=None, contents_hash=None, commit=True):
+        """
+        Creates a pending order of the cart with items, given as dicts of OrderItem columns, in one transaction. Items
+        are inserted in bulk, and the pending order previously created for the cart is cancelled in the same
+        transaction. Without commit, the transaction is left open for the caller to commit. Returns the id of the new
+        order.
+        """
+        session = db.session
         try:
-            query = Order.query.filter_by(cart_id=cart_id).first()
-            if query and query.status == OrderStatus.PAID.value:
+            is_paid = session.query(
+                db.exists().where(Order.cart_id == cart_id, Order.status == OrderStatus.PAID.value)
+            ).scalar()
+            if is_paid:
                 return False, "Cart is already linked to an existing paid order"
 
-            order = cls(user_id=user_id, guest_id=guest_id, cart_id=cart_id)
-            db.session.add(order)
-            db.session.commit()
-            return True, order
+            session.execute(
+                update(Order)
+                .where(Order.cart_id == cart_id, Order.status == OrderStatus.PENDING.value)
+                .values(status=OrderStatus.CANCELLED.value),
+                execution_options={'synchronize_session': False}
+            )
+
+            total_amount = sum(item['quantity'] * item['price'] for item in items)
+            order = cls(
+                user_id=user_id, guest_id=guest_id, cart_id=cart_id, total_amount=total_amount,
+                contents_hash=contents_hash
+            )
+            session.add(order)
+            session.flush()
+            order_id = order.id
+
+            session.execute(insert(OrderItem), [{**item, 'order_id': order_id} for item in items])
+            if commit:
+                session.commit()
+            return True, order_id
         except Exception as e:
-            db.session.rollback()
+            session.rollback()
             return False, f"Failed to create order: {str(e)}"
 
     @classmethod
     def get_order_by_cart_id_for_status(cls, cart_id, status):
         try:
-            order = Order.query.filter_by(cart_id=cart_id, status=status)
-            if order.count() > 0:
-                return True, order.first()
+            order = Order.query.filter_by(cart_id=cart_id, status=status).first()
+            if order:
+                return True, order
             else:
                 return False, "No order linked to this cart"
         except Exception as e:
@@ -68,30 +137,67 @@ class Order(db.Model):
             return False, f"Failed to retrieve order: {str(e)}"
 
     @classmethod
-    def add_item_to_order(cls, order_id, product_id, quantity, price, currency):
-        order = cls.query.get(order_id)
-        if not order:
-            return False, "Order not found"
-
-        order_item = OrderItem.query.filter_by(order_id=order.id, product_id=product_id).first()
-        if order_item:
-            order_item.quantity += quantity
-            order_item.price = price
-            order_item.currency = currency
-        else:
-            order_item = OrderItem(
-                order_id=order.id,
-                product_id=product_id,
-                quantity=quantity,
-                price=price,
-                currency=currency
+    def set_checkout_session(cls, order_id, session_id, url, expires_at, commit=True):
+        session = db.session
+        try:
+            session.execute(
+                update(Order)
+                .where(Order.id == order_id)
+                .values(checkout_session_id=session_id, checkout_url=url, checkout_expires_at=expires_at),
+                execution_options={'synchronize_session': False}
             )
-            db.session.add(order_item)
+            if commit:
+                session.commit()
+            return True, "Checkout session saved"
+        except Exception as e:
+            session.rollback()
+            return False, f"Failed to save checkout session: {str(e)}"
 
-        order.total_amount += quantity * price
-        db.session.commit()
+    @classmethod
+    def cancel_stale_pending_orders(cls, max_age: timedelta, chunk_size=1000):
+        """
+        Cancels pending orders created longer than max_age ago, in chunks of chunk_size orders. Every chunk is a
+        separate transaction, and orders locked by a concurrent change are skipped until the next run. Returns number
+        of cancelled orders and ids of their checkout sessions that have not expired yet.
+        """
+        session = db.session
+        cancelled = 0
+        open_session_ids = []
+        # Compared against the database clock, which sets order timestamps
+        created_before = db.func.current_timestamp() - max_age
+
+        try:
+            while True:
+                stale_order_ids = (
+                    select(Order.id)
+                    .where(Order.status == OrderStatus.PENDING.value, Order.created_at < created_before)
+                    .order_by(Order.created_at)
+                    .limit(chunk_size)
+                    .with_for_update(skip_locked=True)
+                )
+                orders = session.execute(
+                    update(Order)
+                    .where(Order.id.in_(stale_order_ids.scalar_subquery()))
+                    .values(status=OrderStatus.CANCELLED.value)
+                    .returning(Order.checkout_session_id, Order.checkout_expires_at),
+                    execution_options={'synchronize_session': False}
+                ).all()
+                session.commit()
 
-        return True, "Item successfully added to order"
+                now = datetime.utcnow()
+                cancelled += len(orders)
+                open_session_ids += [
+                    order.checkout_session_id for order in orders if order.checkout_session_id and
+                    (order.checkout_expires_at is None or order.checkout_expires_at > now)
+                ]
+                if len(orders) < chunk_size:
+                    break
+
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"Database error during stale pending order cancellation: {e}")
+
+        return cancelled, open_session_ids
 
     @classmethod
     def update_order_status(cls, order_id, new_status):
@@ -109,24 +215,10 @@ class Order(db.Model):
 
         return True, "Order updated"
 
-    def update_total_amount(self, total_amount):
-        self.total_amount = total_amount
-        db.session.commit()
-
     @classmethod
     def cancel_order(cls, order_id):
         return cls.update_order_status(order_id, OrderStatus.CANCELLED.value)
 
-    @classmethod
-    def flag_notification_sent(cls, order_id):
-        order = cls.query.get(order_id)
-        if not order:
-            return False, "Order not found"
-
-        order.notification_sent = True
-        db.session.commit()
-        return True, "Notification flagged as sent"
-
     def to_dict(self):
         return {
             "id": self.id,
@@ -161,3 +253,49 @@ class OrderItem(db.Model):
             "price": self.price,  # In cents
             "currency": self.currency
         }
+
+
+# Pending orders older than this are cancelled, Stripe checkout sessions expire after 24 hours by default
+_pending_order_max_age_hours = 24
+# Seconds between stale pending order cancellations
+_pending_order_reaper_interval = 3600
+_pending_order_reaper_chunk_size = 1000
+# Max number of concurrent Stripe calls expiring checkout sessions of cancelled orders
+_checkout_expire_concurrency = 4
+
+
+def initialize_pending_order_reaper(app, expire_checkout_session=None):
+    """
+    Periodically cancels stale pending orders. When PENDING_ORDER_EXPIRE_CHECKOUT is enabled, checkout sessions of
+    cancelled orders that are still open are expired with expire_checkout_session, which receives the session id.
+    """
+    global _pending_order_max_age_hours, _pending_order_reaper_interval, _checkout_expire_concurrency
+    _pending_order_max_age_hours = int(os.getenv('PENDING_ORDER_MAX_AGE_HOURS', _pending_order_max_age_hours))
+    _pending_order_reaper_interval = int(os.getenv('PENDING_ORDER_REAPER_INTERVAL', _pending_order_reaper_interval))
+    _checkout_expire_concurrency = int(os.getenv('PENDING_ORDER_EXPIRE_CONCURRENCY', _checkout_expire_concurrency))
+    if _pending_order_max_age_hours <= 0 or _pending_order_reaper_interval <= 0:
+        return
+    if os.getenv('PENDING_ORDER_EXPIRE_CHECKOUT', 'false').lower() != 'true':
+        expire_checkout_session = None
+
+    def reap():
+        with app.app_context():
+            cancel_stale_pending_orders(expire_checkout_session)
+
+    run_periodically('pending-order-reaper', _pending_order_reaper_interval, reap)
+
+
+def cancel_stale_pending_orders(expire_checkout_session=None):
+    started = time.perf_counter()
+    cancelled, session_ids = Order.cancel_stale_pending_orders(
+        timedelta(hours=_pending_order_max_age_hours), chunk_size=_pending_order_reaper_chunk_size
+    )
+
+    expired = 0
+    if expire_checkout_session and session_ids:
+        with ThreadPoolExecutor(max_workers=max(1, _checkout_expire_concurrency)) as executor:
+            expired = sum(1 for success, _ in executor.map(expire_checkout_session, session_ids) if success)
+
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"Cancelled {cancelled} stale pending orders and expired {expired} of {len(session_ids)} open checkout "
+          f"sessions in {elapsed:.1f} ms")
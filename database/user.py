@@ -3,6 +3,11 @@ import hashlib
 from sqlalchemy import Boolean
 
 from database import db
+from utils.cache import TTLCache
+
+# Ids of existing users. Users are never deleted, so the cache is valid in every worker. The active flag is not
+# cached, a deactivation in one worker would not be seen by the others.
+_existing_user_ids = TTLCache(max_size=10000, ttl=300)
 
 
 class User(db.Model):
@@ -54,6 +59,16 @@ class User(db.Model):
         user = cls.query.filter_by(id=user_id).first()
         return user
 
+    @classmethod
+    def user_id_exists(cls, user_id):
+        user_id = int(user_id)
+        if _existing_user_ids.get(user_id):
+            return True
+        exists = db.session.query(db.exists().where(cls.id == user_id)).scalar()
+        if exists:
+            _existing_user_ids.set(user_id, True)
+        return exists
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -91,8 +106,7 @@ class User(db.Model):
             except ValueError:
                 return False, "Invalid user_id format"
 
-            user = User.query.filter_by(id=user_id).first()
-            if not user:
+            if not cls.user_id_exists(user_id):
                 return False, "User does not exist"
 
         if guest_id and (not isinstance(guest_id, str) or guest_id.strip() == ""):
@@ -0,0 +1,136 @@
+import enum
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, String, Text, Integer, DateTime, Index, select, update, exists, or_, and_, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import aliased
+
+from database import db
+from database.lease_queue import LeaseQueue
+
+
+class WebhookEventStatus(enum.Enum):
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    PROCESSED = 'processed'
+    FAILED = 'failed'
+
+
+# Events that are not finished yet, they hold back later events of the same ordering key
+_unfinished_statuses = (WebhookEventStatus.PENDING.value, WebhookEventStatus.PROCESSING.value)
+
+
+class WebhookEvent(LeaseQueue, db.Model):
+    """
+    Inbox of verified Stripe webhook events. Events are acknowledged once stored and processed by background workers.
+    Timestamps are UTC.
+    """
+    pending_status = WebhookEventStatus.PENDING.value
+    leased_status = WebhookEventStatus.PROCESSING.value
+    finished_status = WebhookEventStatus.PROCESSED.value
+    failed_status = WebhookEventStatus.FAILED.value
+    finished_at_column = 'processed_at'
+
+    __table_args__ = (
+        Index('ix_webhook_event_status_next_attempt_at', 'status', 'next_attempt_at'),
+        Index('ix_webhook_event_ordering_key_received_at', 'ordering_key', 'received_at'),
+    )
+
+    id = Column(String, primary_key=True)  # Stripe event id
+    type = Column(String, nullable=False)
+    # Events of the same ordering key, e.g. of the same order, are processed one at a time in order of arrival
+    ordering_key = Column(String, nullable=True)
+    payload = Column(Text, nullable=False)
+    status = Column(String, nullable=False, default=WebhookEventStatus.PENDING.value)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    received_at = Column(DateTime, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    # End of the lease of the worker processing the event
+    locked_until = Column(DateTime, nullable=True)
+    processed_at = Column(DateTime, nullable=True)
+
+    @classmethod
+    def store_event(cls, event_id, event_type, payload, ordering_key=None):
+        """
+        Stores the event unless an event with the same id was already stored. Returns whether it was stored.
+        """
+        now = datetime.utcnow()
+        result = db.session.execute(
+            pg_insert(WebhookEvent)
+            .values(
+                id=event_id,
+                type=event_type,
+                ordering_key=ordering_key,
+                payload=payload,
+                status=WebhookEventStatus.PENDING.value,
+                attempts=0,
+                received_at=now,
+                next_attempt_at=now
+            )
+            .on_conflict_do_nothing(index_elements=[WebhookEvent.id])
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    def claim_events(cls, limit, lease: timedelta):
+        """
+        Claims up to limit due events whose earlier events of the same ordering key are finished.
+        """
+        earlier = aliased(WebhookEvent)
+        is_held_back = exists().where(
+            earlier.ordering_key == WebhookEvent.ordering_key,
+            earlier.status.in_(_unfinished_statuses),
+            or_(
+                earlier.received_at < WebhookEvent.received_at,
+                and_(earlier.received_at == WebhookEvent.received_at, earlier.id < WebhookEvent.id)
+            )
+        )
+        events = cls._claim(
+            limit, lease,
+            returning=(WebhookEvent.id, WebhookEvent.type, WebhookEvent.payload, WebhookEvent.received_at,
+                       WebhookEvent.attempts),
+            order_by=WebhookEvent.received_at,
+            criteria=(~is_held_back,)
+        )
+        return sorted(events, key=lambda event: event.received_at)
+
+    @classmethod
+    def mark_processed(cls, event_id):
+        cls._update(event_id, status=WebhookEventStatus.PROCESSED.value, processed_at=datetime.utcnow(),
+                    locked_until=None, last_error=None)
+
+    @classmethod
+    def replay_events(cls, event_ids=None, received_since=None, failed_only=False):
+        query = update(WebhookEvent).where(WebhookEvent.status.notin_(_unfinished_statuses))
+        if event_ids:
+            query = query.where(WebhookEvent.id.in_(event_ids))
+        if received_since:
+            query = query.where(WebhookEvent.received_at >= received_since)
+        if failed_only:
+            query = query.where(WebhookEvent.status == WebhookEventStatus.FAILED.value)
+
+        session = db.session
+        result = session.execute(
+            query.values(
+                status=WebhookEventStatus.PENDING.value,
+                attempts=0,
+                next_attempt_at=datetime.utcnow(),
+                last_error=None
+            ),
+            execution_options={'synchronize_session': False}
+        )
+        session.commit()
+        return result.rowcount
+
+    @classmethod
+    def get_inbox_stats(cls):
+        # Number of events by status and receive time of the oldest unfinished event
+        counts = dict(db.session.execute(
+            select(WebhookEvent.status, func.count()).group_by(WebhookEvent.status)
+        ).all())
+        oldest_received_at = db.session.execute(
+            select(func.min(WebhookEvent.received_at)).where(WebhookEvent.status.in_(_unfinished_statuses))
+        ).scalar()
+        return counts, oldest_received_at
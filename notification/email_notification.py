@@ -1,5 +1,6 @@
 import os
 import smtplib
+import time
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
@@ -19,15 +20,14 @@ def initialize_email_notification_env_variables():
     admin_emails = os.getenv('ADMIN_EMAILS')
 
 
-def send_order_confirmation_email_to_customer(recipient_email: str, order_id: str, first_name: str):
-    if not all([smtp_host, smtp_user, smtp_password, smtp_sender_email]):
-        print("One or more required SMTP config environment variables are missing.")
-        return False
+def is_smtp_configured() -> bool:
+    return all([smtp_host, smtp_user, smtp_password, smtp_sender_email])
 
-    msg = MIMEMultipart()
-    msg['From'] = smtp_sender_email
-    msg['To'] = recipient_email
-    msg['Subject'] = "Narudžba zaprimljena"
+
+# Emails are built as dicts of EmailOutbox columns, and sent by the email outbox workers
+
+
+def get_order_confirmation_email_to_customer(recipient_email: str, order_id: str, first_name: str):
     body = f"""
     <html>
     <body>
@@ -38,25 +38,16 @@ def send_order_confirmation_email_to_customer(recipient_email: str, order_id: st
     </body>
     </html>
     """
+    return {
+        'dedupe_key': f'order-confirmation-customer-{order_id}',
+        'order_id': order_id,
+        'recipients': recipient_email,
+        'subject': "Narudžba zaprimljena",
+        'body': body
+    }
 
-    msg.attach(MIMEText(body, 'html'))
 
-    server = None
-    try:
-        server = smtplib.SMTP(smtp_host, 587)
-        server.ehlo()
-        server.login(smtp_user, smtp_password)
-        server.sendmail(smtp_sender_email, recipient_email, msg.as_string())
-        return True
-    except Exception as e:
-        print(f"Failed to send email: {e}")
-        return False
-    finally:
-        if server:
-            server.quit()
-
-
-def send_order_confirmation_email_to_admin(
+def get_order_confirmation_email_to_admin(
         customer_email: str,
         order_id: str,
         first_name: str,
@@ -64,16 +55,6 @@ def send_order_confirmation_email_to_admin(
         payment_id: str,
         shipping_address: str
 ):
-    if not all([smtp_host, smtp_user, smtp_password, smtp_sender_email]):
-        print("One or more required SMTP config environment variables are missing.")
-        return False
-
-    admin_emails_list = admin_emails.split(',')
-
-    msg = MIMEMultipart()
-    msg['From'] = smtp_sender_email
-    msg['To'] = ', '.join(admin_emails_list)
-    msg['Subject'] = f'Narudžba broj {order_id} zaprimljena'
     body = f"""
     <html>
     <body>
@@ -87,30 +68,16 @@ def send_order_confirmation_email_to_admin(
     </body>
     </html>
     """
+    return {
+        'dedupe_key': f'order-confirmation-admin-{order_id}',
+        'order_id': order_id,
+        'recipients': admin_emails or '',
+        'subject': f'Narudžba broj {order_id} zaprimljena',
+        'body': body
+    }
+
 
-    msg.attach(MIMEText(body, 'html'))
-
-    server = None
-    try:
-        server = smtplib.SMTP(smtp_host, 587)
-        server.ehlo()
-        server.login(smtp_user, smtp_password)
-        server.sendmail(smtp_sender_email, admin_emails_list, msg.as_string())
-        return True
-    except Exception as e:
-        print(f"Failed to send email: {e}")
-        return False
-    finally:
-        if server:
-            server.quit()
-
-
-def send_password_reset_email(recipient_email: str, reset_link: str) -> bool:
-    if not all([smtp_host, smtp_user, smtp_password, smtp_sender_email]):
-        print("One or more required SMTP config environment variables are missing.")
-        return False
-
-    subject = "Zahtjev za resetiranje lozinke"
+def get_password_reset_email(recipient_email: str, reset_link: str):
     body = f"""
        <html>
        <body>
@@ -123,23 +90,67 @@ def send_password_reset_email(recipient_email: str, reset_link: str) -> bool:
        </body>
        </html>
        """
+    return {
+        'recipients': recipient_email,
+        'subject': "Zahtjev za resetiranje lozinke",
+        'body': body,
+        'sensitive': True
+    }
+
+
+class SmtpConnection:
+    """
+    Authenticated SMTP connection kept open between emails. Not thread-safe, every outbox worker owns one.
+    """
 
-    msg = MIMEMultipart()
-    msg['From'] = smtp_sender_email
-    msg['To'] = recipient_email
-    msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'html'))
-
-    server = None
-    try:
-        server = smtplib.SMTP(smtp_host, 587)
-        server.ehlo()
-        server.login(smtp_user, smtp_password)
-        server.sendmail(smtp_sender_email, recipient_email, msg.as_string())
-        return True
-    except Exception as e:
-        print(f"Failed to send email: {e}")
-        return False
-    finally:
-        if server:
-            server.quit()
+    def __init__(self, idle_timeout: float):
+        self.idle_timeout = idle_timeout
+        self._server = None
+        self._last_used = 0.0
+
+    def send(self, recipients: str, subject: str, body: str):
+        recipients_list = [recipient.strip() for recipient in recipients.split(',') if recipient.strip()]
+        if not recipients_list:
+            raise ValueError("Email has no recipients")
+
+        msg = MIMEMultipart()
+        msg['From'] = smtp_sender_email
+        msg['To'] = ', '.join(recipients_list)
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'html'))
+
+        message = msg.as_string()
+        try:
+            try:
+                self._get_server().sendmail(smtp_sender_email, recipients_list, message)
+            except smtplib.SMTPServerDisconnected:
+                # Server closed the idle connection, the email is sent once more over a new one
+                self.close()
+                self._get_server().sendmail(smtp_sender_email, recipients_list, message)
+        except (smtplib.SMTPException, OSError):
+            # Connection may be left in an unknown state, the next email opens a new one
+            self.close()
+            raise
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self._server and time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+
+    def close(self):
+        if self._server:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+    def _get_server(self):
+        if self._server is None:
+            if not is_smtp_configured():
+                raise RuntimeError("One or more required SMTP config environment variables are missing.")
+            server = smtplib.SMTP(smtp_host, 587)
+            server.ehlo()
+            server.login(smtp_user, smtp_password)
+            self._server = server
+        return self._server
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from datetime import timedelta
+
+from database.email_outbox import EmailOutbox
+from notification.email_notification import SmtpConnection, is_smtp_configured
+from utils.lease_worker import LeaseQueueWorkers
+
+# Number of worker threads sending emails in this process, each keeps its own SMTP connection open
+_worker_count = 2
+_claim_batch_size = 10
+# Time a worker has to send a claimed email before it can be claimed by another worker
+_sending_lease = timedelta(minutes=2)
+# SMTP connection of a worker without emails to send is closed after this many seconds
+_smtp_idle_timeout = 60
+# Failed email is retried after 30 s, 1 min, 2 min, ... at most an hour apart, and given up after max attempts
+_retry_base_delay = 30
+_retry_max_delay = 3600
+_max_attempts = 10
+# Sent emails are kept for this long
+_sent_email_retention = timedelta(days=30)
+
+_workers = LeaseQueueWorkers(
+    'email-outbox',
+    queue=EmailOutbox,
+    claim=lambda: EmailOutbox.claim_emails(limit=_claim_batch_size, lease=_sending_lease),
+    retry_base_delay=_retry_base_delay,
+    retry_max_delay=_retry_max_delay,
+    max_attempts=_max_attempts,
+    retention=_sent_email_retention
+)
+_connections = threading.local()
+
+
+def initialize_email_outbox(app):
+    """
+    Starts workers sending enqueued emails. Workers are not started without SMTP config, and emails stay enqueued
+    until a process with SMTP config sends them.
+    """
+    global _worker_count
+    _worker_count = int(os.getenv('EMAIL_WORKERS', _worker_count))
+    if not is_smtp_configured():
+        print("One or more required SMTP config environment variables are missing, emails are not sent.")
+        return
+
+    _workers.start(app, _worker_count, _send_email, on_idle=_close_idle_connection)
+
+
+def enqueue_emails(emails):
+    """
+    Persists emails, built by notification.email_notification, for the outbox workers. Emails without recipients, e.g.
+    to admins when none are configured, are skipped.
+    """
+    emails = [email for email in emails if email['recipients']]
+    if emails:
+        EmailOutbox.enqueue(emails)
+        _workers.notify()
+
+
+def _get_connection() -> SmtpConnection:
+    # Every worker thread keeps its own connection
+    connection = getattr(_connections, 'connection', None)
+    if connection is None:
+        connection = _connections.connection = SmtpConnection(idle_timeout=_smtp_idle_timeout)
+    return connection
+
+
+def _close_idle_connection():
+    _get_connection().close_if_idle()
+
+
+def _send_email(email):
+    started = time.perf_counter()
+    try:
+        _get_connection().send(email.recipients, email.subject, email.body)
+    except Exception as e:
+        result = _workers.retry_or_fail(email, e)
+        print(f"Failed to send email {email.id}, {result}")
+        return
+
+    EmailOutbox.mark_sent(email.id, order_id=email.order_id)
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"Sent email {email.id} in {elapsed:.1f} ms")
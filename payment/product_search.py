@@ -0,0 +1,127 @@
+import bisect
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Mapping, Tuple, List, Dict, Optional
+
+# Weight of a term found in a product field, name matches rank above metadata and description matches
+_name_weight = 3.0
+_metadata_weight = 2.0
+_description_weight = 1.0
+# Prefix matches rank below exact term matches
+_prefix_match_factor = 0.5
+# Max number of index terms a single query prefix expands to
+_max_prefix_terms = 100
+# Metadata keys holding flags and ids rather than searchable text
+_ignored_metadata_keys = frozenset({'category_id', 'featured', 'in_stock', 'discount'})
+
+_token_regex = re.compile(r'\w+')
+# Letters that Unicode normalization does not decompose into a base letter and a diacritic
+_letter_replacements = str.maketrans({'đ': 'd', 'ø': 'o', 'ł': 'l', 'ß': 'ss', 'æ': 'ae', 'œ': 'oe'})
+
+
+def normalize_text(text: Optional[str]) -> str:
+    """
+    Lowercases text and strips diacritics, so that e.g. "Čaša", "časa" and "casa" all match.
+    """
+    text = (text or '').lower().translate(_letter_replacements)
+    return ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return _token_regex.findall(normalize_text(text))
+
+
+def _get_product_terms(product) -> Dict[str, float]:
+    texts = [(product.name, _name_weight), (product.description, _description_weight)]
+    texts += [(value, _metadata_weight) for key, value in product.metadata.items() if key not in _ignored_metadata_keys]
+
+    terms = {}
+    for text, weight in texts:
+        for token in tokenize(text):
+            terms[token] = max(terms.get(token, 0.0), weight)
+    return terms
+
+
+@dataclass(frozen=True)
+class ProductSearchIndex:
+    """
+    Inverted index over product name, description and metadata. Terms are kept sorted so that the last query token can
+    be matched as a prefix for autocomplete.
+    """
+    postings: Mapping[str, Mapping[str, float]] = field(default_factory=lambda: MappingProxyType({}))
+    terms: Tuple[str, ...] = ()
+
+    @classmethod
+    def build(cls, products) -> 'ProductSearchIndex':
+        postings = {}
+        for product in products:
+            for term, weight in _get_product_terms(product).items():
+                postings.setdefault(term, {})[product.id] = weight
+        return cls(
+            postings=MappingProxyType({term: MappingProxyType(ids) for term, ids in postings.items()}),
+            terms=tuple(sorted(postings))
+        )
+
+    def patch(self, old_product, product) -> 'ProductSearchIndex':
+        """
+        Returns a copy of the index with the terms of old_product replaced by the terms of product, either may be None.
+        """
+        product_id = (product or old_product).id
+        old_terms = _get_product_terms(old_product) if old_product else {}
+        new_terms = _get_product_terms(product) if product else {}
+
+        postings = dict(self.postings)
+        terms = list(self.terms)
+        for term in old_terms.keys() - new_terms.keys():
+            ids = {key: value for key, value in postings[term].items() if key != product_id}
+            if ids:
+                postings[term] = MappingProxyType(ids)
+            else:
+                del postings[term]
+                del terms[bisect.bisect_left(terms, term)]
+        for term, weight in new_terms.items():
+            if term not in postings:
+                bisect.insort(terms, term)
+            postings[term] = MappingProxyType({**postings.get(term, {}), product_id: weight})
+
+        return ProductSearchIndex(postings=MappingProxyType(postings), terms=tuple(terms))
+
+    def _match_token(self, token: str, is_prefix: bool) -> Mapping[str, float]:
+        matches = self.postings.get(token, {})
+        if not is_prefix:
+            return matches
+        matches = dict(matches)
+
+        start = bisect.bisect_right(self.terms, token)
+        end = min(bisect.bisect_left(self.terms, token + '\uffff'), start + _max_prefix_terms)
+        for term in self.terms[start:end]:
+            for product_id, weight in self.postings[term].items():
+                score = weight * _prefix_match_factor
+                if score > matches.get(product_id, 0.0):
+                    matches[product_id] = score
+        return matches
+
+    def search(self, query: str) -> Dict[str, float]:
+        """
+        Returns scores of products matching all query tokens by product id. The last token also matches terms it is
+        a prefix of.
+        """
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return {}
+
+        token_matches = [self._match_token(token, is_prefix=index == len(tokens) - 1) for index, token in
+                         enumerate(tokens)]
+        token_matches.sort(key=len)
+
+        scores = {}
+        for product_id, score in token_matches[0].items():
+            for matches in token_matches[1:]:
+                if product_id not in matches:
+                    break
+                score += matches[product_id]
+            else:
+                scores[product_id] = score
+        return scores
@@ -0,0 +1,236 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Optional, List, Tuple
+
+import stripe
+
+# Snapshot file layout: header (magic, source, version, published time, payload length) followed by JSON payload.
+# Source is derived from the Stripe key so that development and production catalogs never mix on the same host.
+_magic = b'MPCATLG1'
+_header = struct.Struct('<8s16sQdQ')
+# Single product patches on top of a snapshot version are appended to a separate file, one JSON line each, after a
+# header line naming the version. Every publish replaces it with an empty one for the new version.
+
+_snapshot_path = None
+
+
+def initialize_product_snapshot():
+    global _snapshot_path
+    _snapshot_path = os.getenv(
+        'PRODUCT_CATALOG_SNAPSHOT_PATH',
+        os.path.join(tempfile.gettempdir(), 'marketplace-catalog.snapshot')
+    )
+
+
+@dataclass(frozen=True)
+class SnapshotHeader:
+    version: int
+    published_at: float
+    file_id: tuple
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    version: int
+    published_at: float
+    products: List[dict]
+
+
+def is_snapshot_enabled() -> bool:
+    return bool(_snapshot_path)
+
+
+def _get_source() -> bytes:
+    return hashlib.sha256((stripe.api_key or '').encode()).digest()[:16]
+
+
+def _get_file_id(path: str) -> Optional[tuple]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+@contextmanager
+def _open_snapshot():
+    try:
+        file = open(_snapshot_path, 'rb')
+    except FileNotFoundError:
+        yield None
+        return
+    with file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield mapped
+
+
+def read_snapshot_header(known_file_id: Optional[tuple] = None) -> Optional[SnapshotHeader]:
+    """
+    Reads only the snapshot header. Returns None when snapshot is missing, invalid, or it is the same file as
+    known_file_id, which makes the periodic check a single stat call when nothing was published.
+    """
+    if not is_snapshot_enabled():
+        return None
+    file_id = _get_file_id(_snapshot_path)
+    if file_id is None or file_id == known_file_id:
+        return None
+    try:
+        with _open_snapshot() as mapped:
+            if mapped is None or len(mapped) < _header.size:
+                return None
+            magic, source, version, published_at, _ = _header.unpack_from(mapped)
+    except (OSError, ValueError):
+        return None
+    if magic != _magic or source != _get_source():
+        return None
+    return SnapshotHeader(version=version, published_at=published_at, file_id=file_id)
+
+
+def read_snapshot() -> Optional[Snapshot]:
+    if not is_snapshot_enabled():
+        return None
+    try:
+        with _open_snapshot() as mapped:
+            if mapped is None or len(mapped) < _header.size:
+                return None
+            magic, source, version, published_at, length = _header.unpack_from(mapped)
+            if magic != _magic or source != _get_source() or len(mapped) < _header.size + length:
+                return None
+            products = json.loads(mapped[_header.size:_header.size + length])
+    except (OSError, ValueError) as e:
+        print(f"Failed to read product catalog snapshot: {e}")
+        return None
+    return Snapshot(version=version, published_at=published_at, products=products)
+
+
+def publish_snapshot(products: List[dict], published_at: Optional[float] = None) -> int:
+    """
+    Atomically replaces the snapshot with a new version. Must be called while holding publisher_lock. Readers that
+    still have the previous file mapped keep reading it until they notice the new version.
+    """
+    if not is_snapshot_enabled():
+        return 0
+
+    current = read_snapshot_header()
+    version = current.version + 1 if current else 1
+    payload = json.dumps(products, separators=(',', ':')).encode()
+    header = _header.pack(_magic, _get_source(), version, published_at or time.time(), len(payload))
+
+    directory = os.path.dirname(os.path.abspath(_snapshot_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.catalog-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(header)
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, _snapshot_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    _replace_patches(version)
+    return version
+
+
+def _get_patches_path() -> str:
+    return f'{_snapshot_path}.patches'
+
+
+def _get_patches_header(version: int) -> bytes:
+    return json.dumps({'source': _get_source().hex(), 'version': version}).encode() + b'\n'
+
+
+def _replace_patches(version: int):
+    directory = os.path.dirname(os.path.abspath(_snapshot_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.catalog-patches-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(_get_patches_header(version))
+        os.replace(temp_path, _get_patches_path())
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def append_snapshot_patch(version: int, product_id: str, product: Optional[dict]):
+    """
+    Appends a patch of a single product, None when it was deleted, on top of snapshot version. Must be called while
+    holding publisher_lock.
+    """
+    if not is_snapshot_enabled():
+        return
+    try:
+        with open(_get_patches_path(), 'rb') as file:
+            header = file.readline()
+    except FileNotFoundError:
+        header = None
+    if header != _get_patches_header(version):
+        _replace_patches(version)
+
+    line = json.dumps({'product_id': product_id, 'product': product}, separators=(',', ':')).encode() + b'\n'
+    with open(_get_patches_path(), 'ab') as file:
+        file.write(line)
+
+
+def read_snapshot_patches(version: Optional[int], offset: int) -> Tuple[Optional[int], int, List[tuple]]:
+    """
+    Reads patches appended after offset of the patch file of snapshot version. When the file was since replaced, its
+    patches are read from the start. Returns the version of the file, the offset to continue from and the patches as
+    (product id, product dict) pairs. Nothing is read when the file did not grow, which costs a single stat call.
+    """
+    if not is_snapshot_enabled():
+        return version, offset, []
+    path = _get_patches_path()
+    try:
+        if version is not None and os.stat(path).st_size == offset:
+            return version, offset, []
+        with open(path, 'rb') as file:
+            header = file.readline()
+            if not header.endswith(b'\n'):
+                return version, offset, []
+            file_header = json.loads(header)
+            if file_header.get('source') != _get_source().hex():
+                return None, 0, []
+            if file_header['version'] != version or offset < len(header):
+                offset = len(header)
+            file.seek(offset)
+            data = file.read()
+    except FileNotFoundError:
+        return None, 0, []
+    except (OSError, ValueError) as e:
+        print(f"Failed to read product catalog patches: {e}")
+        return version, offset, []
+
+    # A line that is still being appended is read on the next call
+    end = data.rfind(b'\n') + 1
+    patches = [json.loads(line) for line in data[:end].splitlines()]
+    return file_header['version'], offset + end, [(patch['product_id'], patch['product']) for patch in patches]
+
+
+def publisher_lock():
+    """
+    Cross-process lock held while a catalog is being loaded from Stripe and published, so only one worker of the host
+    talks to Stripe while the others wait for its snapshot.
+    """
+    if not is_snapshot_enabled():
+        return nullcontext()
+    return _file_lock(f'{_snapshot_path}.lock')
+
+
+@contextmanager
+def _file_lock(path: str):
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
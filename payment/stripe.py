@@ -5,5 +5,11 @@ import stripe
 _base_url = "https://api.stripe.com"
 
 
+# Requests failed on the network are retried by the library, with the same idempotency key so that a POST whose
+# response was lost is not executed twice
+_max_network_retries = 2
+
+
 def initialize_stripe():
     stripe.api_key = os.getenv('STRIPE_SK')
+    stripe.max_network_retries = _max_network_retries
@@ -1,9 +1,19 @@
 import os
+import threading
+from concurrent.futures import Future
 from dataclasses import dataclass
 from typing import Dict, List, Any
 
 import stripe
 
+from utils.cache import TTLCache
+
+# Paid checkout sessions by id, looked up by the checkout success request and the webhook, which usually race
+_session_info_cache = TTLCache(max_size=1000, ttl=300)
+# Retrieves of checkout sessions in progress by session id
+_session_info_retrieves: Dict[str, Future] = {}
+_session_info_retrieves_lock = threading.Lock()
+
 
 # Stripe doc reference: https://docs.stripe.com/api/checkout/sessions/create
 def get_stripe_checkout_session(order_id, cart_id, customer_email, items):
@@ -28,6 +38,15 @@ def get_stripe_checkout_session(order_id, cart_id, customer_email, items):
         return False, str(e)
 
 
+# Stripe doc reference: https://docs.stripe.com/api/checkout/sessions/expire
+def expire_checkout_session(session_id):
+    try:
+        stripe.checkout.Session.expire(session_id)
+        return True, "Checkout session expired"
+    except Exception as e:
+        return False, str(e)
+
+
 @dataclass
 class SessionDetails:
     id: str
@@ -67,20 +86,60 @@ class CheckoutSessionInfo:
 def get_checkout_session_info(session_id: str) -> CheckoutSessionInfo:
     try:
         session = stripe.checkout.Session.retrieve(session_id)
-        email = session.get('customer_details', {}).get('email', '')
-        first_name = session.get('customer_details', {}).get('name', '').split()[0]
-        last_name = session.get('customer_details', {}).get('name', '').split()[-1]
-
-        session_details = parse_session_details(session)
-
-        return CheckoutSessionInfo(
-            session=session_details,
-            email=email,
-            first_name=first_name,
-            last_name=last_name
-        )
     except stripe.error.StripeError as e:
         raise RuntimeError(f"Error retrieving checkout session: {e}")
+    return get_checkout_session_info_from_session(session)
+
+
+def get_checkout_session_info_from_session(session) -> CheckoutSessionInfo:
+    """
+    Builds session info from a session object, either retrieved or carried by a checkout.session.* webhook event.
+    """
+    customer_details = session.get('customer_details') or {}
+    names = (customer_details.get('name') or '').split()
+
+    return CheckoutSessionInfo(
+        session=parse_session_details(session),
+        email=customer_details.get('email') or '',
+        first_name=names[0] if names else '',
+        last_name=names[-1] if names else ''
+    )
+
+
+def get_cached_checkout_session_info(session_id: str) -> CheckoutSessionInfo:
+    """
+    Returns session info of a paid session from cache, or retrieves it from Stripe. Concurrent callers for the same
+    session wait for the single retrieve in progress instead of starting their own.
+    """
+    session_info = _session_info_cache.get(session_id)
+    if session_info is not None:
+        return session_info
+
+    with _session_info_retrieves_lock:
+        retrieve = _session_info_retrieves.get(session_id)
+        is_leader = retrieve is None
+        if is_leader:
+            retrieve = _session_info_retrieves[session_id] = Future()
+
+    if not is_leader:
+        return retrieve.result()
+
+    try:
+        session_info = get_checkout_session_info(session_id)
+        cache_checkout_session_info(session_info)
+        retrieve.set_result(session_info)
+    except Exception as e:
+        retrieve.set_exception(e)
+    finally:
+        with _session_info_retrieves_lock:
+            del _session_info_retrieves[session_id]
+    return retrieve.result()
+
+
+def cache_checkout_session_info(session_info: CheckoutSessionInfo):
+    # Only paid sessions are cached, payment status of other sessions can still change
+    if session_info.session.payment_status == 'paid':
+        _session_info_cache.set(session_info.session.id, session_info)
 
 
 def get_checkout_event(payload, sig_header, endpoint_secret):
@@ -93,7 +152,7 @@ def get_checkout_event(payload, sig_header, endpoint_secret):
 
 
 def parse_session_details(session_data) -> SessionDetails:
-    shipping_address = session_data.get('shipping_details', {}).get('address', {})
+    shipping_address = (session_data.get('shipping_details') or {}).get('address') or {}
     shipping_address_formatted = ', '.join(filter(None, [
         shipping_address.get('line1', ''),
         shipping_address.get('line2', ''),
@@ -113,7 +172,7 @@ def parse_session_details(session_data) -> SessionDetails:
         currency=session_data.get('currency', ''),
         customer=session_data.get('customer', ''),
         customer_details=session_data.get('customer_details', {}),
-        customer_email=session_data.get('customer_details', {}).get('email', ''),
+        customer_email=(session_data.get('customer_details') or {}).get('email', ''),
         locale=session_data.get('locale', ''),
         metadata=session_data.get('metadata', {}),
         mode=session_data.get('mode', ''),
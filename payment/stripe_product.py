@@ -1,19 +1,32 @@
-import json
+import bisect
+import heapq
+import os
+import sys
+import threading
 import time
-from dataclasses import dataclass, field
-from typing import Optional, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace, asdict, fields
+from types import MappingProxyType
+from typing import Optional, List, Dict, Tuple, Mapping, FrozenSet, Any
 
 import stripe
 
+from payment.product_search import ProductSearchIndex
+from payment.product_snapshot import Snapshot, publisher_lock, read_snapshot, read_snapshot_header, publish_snapshot, \
+    is_snapshot_enabled, initialize_product_snapshot, append_snapshot_patch, read_snapshot_patches
+from utils.common import safe_int
 
-@dataclass
+
+# Catalog objects are slotted and immutable, a single catalog instance is shared by every request of the worker.
+# Mappings are read-only and left out of the hash.
+@dataclass(frozen=True, slots=True)
 class StripePrice:
     id: str
     unit_amount: int
     currency: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class StripeProduct:
     id: str
     object: str
@@ -21,14 +34,14 @@ class StripeProduct:
     created: int
     default_price: Optional[StripePrice] = None
     description: Optional[str] = None
-    images: List[str] = field(default_factory=list)
-    features: List[str] = field(default_factory=list)
+    images: Tuple[str, ...] = ()
+    features: Tuple[Mapping[str, Any], ...] = field(default=(), hash=False)
     livemode: bool = False
-    attributes: List[str] = field(default_factory=list)
-    marketing_features: List[str] = field(default_factory=list)
-    metadata: Dict[str, str] = field(default_factory=dict)
+    attributes: Tuple[str, ...] = ()
+    marketing_features: Tuple[Mapping[str, Any], ...] = field(default=(), hash=False)
+    metadata: Mapping[str, str] = field(default_factory=lambda: MappingProxyType({}), hash=False)
     name: str = ""
-    package_dimensions: Optional[dict] = None
+    package_dimensions: Optional[Mapping[str, Any]] = field(default=None, hash=False)
     shippable: Optional[bool] = None
     statement_descriptor: Optional[str] = None
     tax_code: Optional[str] = None
@@ -38,91 +51,659 @@ class StripeProduct:
     url: Optional[str] = None
 
 
-# Time-to-Live in seconds
+def get_discounted_unit_amount(product: StripeProduct) -> int:
+    """
+    Unit amount of the product default price, lowered by the discount percentage from product metadata if it has one.
+    Rounded to whole cents, the amount charged by Stripe.
+    """
+    unit_amount = product.default_price.unit_amount
+    discount = safe_int(product.metadata.get('discount'))
+    if discount and 0 < discount < 100:
+        return round(unit_amount * (100 - discount) / 100)
+    return unit_amount
+
+
+def _get_price_sort_value(product: StripeProduct):
+    unit_amount = product.default_price.unit_amount if product.default_price else None
+    return unit_amount is None, unit_amount or 0
+
+
+_product_sort_values = {
+    'price': _get_price_sort_value,
+    'created': lambda product: (product.created,),
+    'updated': lambda product: (product.updated,),
+    'discount': lambda product: (safe_int(product.metadata.get('discount')) or 0,),
+}
+
+PRODUCT_SORT_FIELDS = tuple(_product_sort_values)
+
+
+def get_product_sort_key(sort_field: str, product: StripeProduct) -> tuple:
+    # Product id breaks ties, so every product has a unique position usable as a pagination cursor
+    return *_product_sort_values[sort_field](product), product.id
+
+
+@dataclass(frozen=True)
+class ProductIndex:
+    """
+    Immutable lookup tables over a catalog snapshot. Built once per cache refresh so that reads cost time proportional
+    to the result size instead of the catalog size. Every product tuple keeps the catalog order.
+    """
+    products: Tuple[StripeProduct, ...] = ()
+    by_id: Mapping[str, StripeProduct] = field(default_factory=lambda: MappingProxyType({}))
+    positions: Mapping[str, int] = field(default_factory=lambda: MappingProxyType({}))
+    by_category_id: Mapping[Optional[int], Tuple[StripeProduct, ...]] = field(
+        default_factory=lambda: MappingProxyType({})
+    )
+    category_ids: Tuple[str, ...] = ()
+    featured: Tuple[StripeProduct, ...] = ()
+    featured_ids: FrozenSet[str] = frozenset()
+    in_stock: Tuple[StripeProduct, ...] = ()
+    in_stock_ids: FrozenSet[str] = frozenset()
+    search_index: ProductSearchIndex = field(default_factory=ProductSearchIndex)
+    # Whole catalog in ascending order of each sort field
+    sort_orders: Mapping[str, Tuple[StripeProduct, ...]] = field(default_factory=lambda: MappingProxyType({}))
+    # Values derived from this catalog version, e.g. serialized responses, dropped together with the index
+    views: Dict = field(default_factory=dict, compare=False, repr=False)
+
+    @classmethod
+    def build(cls, products: List[StripeProduct]) -> 'ProductIndex':
+        by_category_id = {}
+        for product in products:
+            category_id = safe_int(product.metadata.get('category_id'))
+            by_category_id.setdefault(category_id, []).append(product)
+
+        featured = tuple(product for product in products if product.metadata.get('featured') == 'true')
+        in_stock = tuple(product for product in products if product.metadata.get('in_stock') == 'true')
+        category_ids = {product.metadata['category_id'] for product in products if 'category_id' in product.metadata}
+
+        return cls(
+            products=tuple(products),
+            by_id=MappingProxyType({product.id: product for product in products}),
+            positions=MappingProxyType({product.id: position for position, product in enumerate(products)}),
+            by_category_id=MappingProxyType({key: tuple(value) for key, value in by_category_id.items()}),
+            category_ids=tuple(sorted(category_ids)),
+            featured=featured,
+            featured_ids=frozenset(product.id for product in featured),
+            in_stock=in_stock,
+            in_stock_ids=frozenset(product.id for product in in_stock),
+            search_index=ProductSearchIndex.build(products),
+            sort_orders=MappingProxyType({
+                sort_field: tuple(sorted(products, key=lambda product: get_product_sort_key(sort_field, product)))
+                for sort_field in PRODUCT_SORT_FIELDS
+            })
+        )
+
+    def patch(self, product_id: str, product: Optional[StripeProduct]) -> 'ProductIndex':
+        """
+        Returns a copy of the index with a single product added, replaced or removed (product is None). Only the
+        entries of the indexes the product belongs to are rebuilt.
+        """
+        old_product = self.by_id.get(product_id)
+        if old_product is None and product is None:
+            return self
+
+        by_id = dict(self.by_id)
+        positions = dict(self.positions)
+        by_id.pop(product_id, None)
+        if product is not None:
+            by_id[product_id] = product
+            if product_id not in positions:
+                positions[product_id] = positions[self.products[-1].id] + 1 if self.products else 0
+        else:
+            positions.pop(product_id, None)
+
+        by_category_id = dict(self.by_category_id)
+        affected_categories = {safe_int(p.metadata.get('category_id')) for p in (old_product, product) if p}
+        for category_id in affected_categories:
+            include = product is not None and safe_int(product.metadata.get('category_id')) == category_id
+            category_products = _patch_products(
+                by_category_id.get(category_id, ()), positions, product_id, product if include else None
+            )
+            if category_products:
+                by_category_id[category_id] = category_products
+            else:
+                by_category_id.pop(category_id, None)
+
+        category_ids = set(self.category_ids)
+        if old_product and 'category_id' in old_product.metadata:
+            raw_category_id = old_product.metadata['category_id']
+            category_products = by_category_id.get(safe_int(raw_category_id), ())
+            if not any(p.metadata.get('category_id') == raw_category_id and p.id != product_id
+                       for p in category_products):
+                category_ids.discard(raw_category_id)
+        if product and 'category_id' in product.metadata:
+            category_ids.add(product.metadata['category_id'])
+
+        is_featured = product is not None and product.metadata.get('featured') == 'true'
+        is_in_stock = product is not None and product.metadata.get('in_stock') == 'true'
+        featured = _patch_products(self.featured, positions, product_id, product if is_featured else None)
+        in_stock = _patch_products(self.in_stock, positions, product_id, product if is_in_stock else None)
+
+        return ProductIndex(
+            products=_patch_products(self.products, positions, product_id, product),
+            by_id=MappingProxyType(by_id),
+            positions=MappingProxyType(positions),
+            by_category_id=MappingProxyType(by_category_id),
+            category_ids=tuple(sorted(category_ids)),
+            featured=featured,
+            featured_ids=self.featured_ids | {product_id} if is_featured else self.featured_ids - {product_id},
+            in_stock=in_stock,
+            in_stock_ids=self.in_stock_ids | {product_id} if is_in_stock else self.in_stock_ids - {product_id},
+            search_index=self.search_index.patch(old_product, product),
+            sort_orders=MappingProxyType({
+                sort_field: _patch_sort_order(sort_field, self.sort_orders.get(sort_field, ()), product_id, product)
+                for sort_field in PRODUCT_SORT_FIELDS
+            })
+        )
+
+    def sort(self, products: Tuple[StripeProduct, ...], sort_field: str) -> Tuple[StripeProduct, ...]:
+        """
+        Returns products in ascending order of sort_field. Order of the whole catalog is precomputed.
+        """
+        if products is self.products:
+            return self.sort_orders[sort_field]
+        return tuple(sorted(products, key=lambda product: get_product_sort_key(sort_field, product)))
+
+    def search(self, query: str, limit: int) -> List[StripeProduct]:
+        """
+        Returns up to limit products matching the full text query, best match first and in catalog order among equal
+        matches.
+        """
+        scores = self.search_index.search(query)
+        best_ids = heapq.nsmallest(
+            limit, scores, key=lambda product_id: (-scores[product_id], self.positions[product_id])
+        )
+        return [self.by_id[product_id] for product_id in best_ids]
+
+    def get_by_ids(self, product_ids: List[str]) -> List[StripeProduct]:
+        unique_ids = {product_id for product_id in product_ids if product_id in self.by_id}
+        return [self.by_id[product_id] for product_id in sorted(unique_ids, key=self.positions.__getitem__)]
+
+    def filter(self, category_id: Optional[str] = None, featured=False, in_stock=False) -> Tuple[StripeProduct, ...]:
+        # Scan only the smallest matching index and probe the remaining ones by id
+        candidates = []
+        if category_id:
+            candidates.append((self.by_category_id.get(safe_int(category_id), ()), None))
+        if featured:
+            candidates.append((self.featured, self.featured_ids))
+        if in_stock:
+            candidates.append((self.in_stock, self.in_stock_ids))
+
+        if not candidates:
+            return self.products
+
+        candidates.sort(key=lambda candidate: len(candidate[0]))
+        smallest, _ = candidates[0]
+        if len(candidates) == 1:
+            return smallest
+
+        category_key = safe_int(category_id) if category_id else None
+        return tuple(
+            product for product in smallest
+            if (not category_id or safe_int(product.metadata.get('category_id')) == category_key)
+            and all(product.id in ids for _, ids in candidates[1:] if ids is not None)
+        )
+
+
+def _patch_products(products: Tuple[StripeProduct, ...], positions: Mapping[str, int], product_id: str,
+                    product: Optional[StripeProduct]) -> Tuple[StripeProduct, ...]:
+    products = tuple(p for p in products if p.id != product_id)
+    if product is None:
+        return products
+    at = bisect.bisect_left(products, positions[product_id], key=lambda p: positions[p.id])
+    return products[:at] + (product,) + products[at:]
+
+
+def _patch_sort_order(sort_field: str, products: Tuple[StripeProduct, ...], product_id: str,
+                      product: Optional[StripeProduct]) -> Tuple[StripeProduct, ...]:
+    products = tuple(p for p in products if p.id != product_id)
+    if product is None:
+        return products
+    at = bisect.bisect_left(
+        products, get_product_sort_key(sort_field, product), key=lambda p: get_product_sort_key(sort_field, p)
+    )
+    return products[:at] + (product,) + products[at:]
+
+
+# Time-to-Live in seconds, also the interval of the full catalog reconcile when product and price webhooks are enabled
 # 15 min
 _ttl = 900
+# Expired catalog keeps being served for this many seconds while a background refresh is running
+# 1 hour
+_max_staleness = 3600
+# Delay before a failed refresh is retried, stale catalog is served in the meantime
+_refresh_retry_delay = 30
+# Refreshes expired catalog in background instead of blocking the request that noticed the expiration
+_background_refresh = True
 
 
 @dataclass
 class ProductCache:
-    cache: List[StripeProduct] = field(default_factory=list)
+    index: ProductIndex = field(default_factory=ProductIndex)
     cache_expiration_time: float = field(default_factory=lambda: time.time() + _ttl)
+    next_refresh_attempt_time: float = 0.0
+    # Version and file of the shared snapshot the cache was last loaded from or published to
+    version: int = 0
+    snapshot_file_id: Optional[tuple] = None
+    next_snapshot_check_time: float = 0.0
+    # Cache version, patch file version and offset up to which patches of the shared snapshot were applied
+    patches_position: Tuple[int, Optional[int], int] = (0, None, 0)
+    refresh_lock: threading.Lock = field(default_factory=threading.Lock)
+    patch_lock: threading.Lock = field(default_factory=threading.Lock)
+    patches_lock: threading.Lock = field(default_factory=threading.Lock)
+    # Webhook patches received while a full reload is running, re-applied on top of the reloaded catalog
+    refresh_patches: Optional[List[Tuple[str, Optional[StripeProduct]]]] = None
+
+    @property
+    def cache(self) -> Tuple[StripeProduct, ...]:
+        return self.index.products
 
     def is_expired(self):
         return time.time() > self.cache_expiration_time
 
-    def update_cache(self, new_cache):
-        self.cache = new_cache
-        self.cache_expiration_time = time.time() + _ttl
+    def is_too_stale(self):
+        return time.time() > self.cache_expiration_time + _max_staleness
+
+    def begin_update(self):
+        with self.patch_lock:
+            self.refresh_patches = []
+
+    def abort_update(self):
+        with self.patch_lock:
+            self.refresh_patches = None
+
+    def update_cache(self, new_cache, version: int = 0, published_at: Optional[float] = None):
+        # Index is built before swapping so readers never observe a half-built catalog
+        index = ProductIndex.build(new_cache)
+        with self.patch_lock:
+            for product_id, product in self.refresh_patches or []:
+                index = index.patch(product_id, product)
+            self.refresh_patches = None
+            self.index = index
+            self.version = version
+        self.cache_expiration_time = (published_at or time.time()) + _ttl
+
+    def patch_product(self, product_id: str, product: Optional[StripeProduct]) -> bool:
+        with self.patch_lock:
+            return self._patch_product(product_id, product)
+
+    def apply_snapshot_patches(self, version: int, patches: List[Tuple[str, Optional[StripeProduct]]]):
+        with self.patch_lock:
+            # Patches of an older snapshot are already part of a newer one, or were overwritten by it
+            if self.version != version:
+                return
+            for product_id, product in patches:
+                # Worker that applied the event itself reads back its own patch
+                if self.index.by_id.get(product_id) != product:
+                    self._patch_product(product_id, product)
+
+    def _patch_product(self, product_id: str, product: Optional[StripeProduct]) -> bool:
+        current = self.index.by_id.get(product_id)
+        # Stripe does not guarantee event ordering, older product versions are ignored
+        if current and product and product.updated < current.updated:
+            return False
+        self.index = self.index.patch(product_id, product)
+        if self.refresh_patches is not None:
+            self.refresh_patches.append((product_id, product))
+        return True
 
     def get_product_by_id(self, product_id: str) -> Optional[StripeProduct]:
-        for product in self.cache:
-            if product.id == product_id:
-                return product
-        return None
+        return self.index.by_id.get(product_id)
 
 
 _product_cache = ProductCache()
 
 
-# Stripe doc reference: https://stripe.com/docs/api/products/list, https://docs.stripe.com/api/prices/retrieve
+# Stripe doc reference: https://stripe.com/docs/api/products/list, https://docs.stripe.com/api/expanding_objects
 def get_stripe_products():
-    global _product_cache
+    _sync_from_snapshot()
     if _product_cache.cache and not _product_cache.is_expired():
         return _product_cache.cache
 
-    products_response = stripe.Product.list(limit=100)
-    products_json = json.dumps(products_response)
-    data = json.loads(products_json)
-    products = []
+    if _product_cache.cache and _background_refresh and not _product_cache.is_too_stale():
+        _refresh_products_in_background()
+        return _product_cache.cache
 
-    for prod in data['data']:
-        default_price_id = prod.get('default_price')
-        default_price_data = None
+    _refresh_products()
+    return _product_cache.cache
 
-        if default_price_id:
-            default_price = stripe.Price.retrieve(default_price_id)
-            default_price_data = StripePrice(
-                id=default_price.id,
-                unit_amount=default_price.unit_amount,
-                currency=default_price.currency
-            )
-        product = StripeProduct(
-            id=prod['id'],
-            object=prod['object'],
-            active=prod['active'],
-            created=prod['created'],
-            default_price=default_price_data,
-            description=prod.get('description'),
-            images=prod.get('images', []),
-            features=prod.get('features', []),
-            livemode=prod.get('livemode', False),
-            attributes=prod.get('attributes', []),
-            marketing_features=prod.get('marketing_features', []),
-            metadata=prod.get('metadata', {}),
-            name=prod['name'],
-            package_dimensions=prod.get('package_dimensions'),
-            shippable=prod.get('shippable'),
-            statement_descriptor=prod.get('statement_descriptor'),
-            tax_code=prod.get('tax_code'),
-            unit_label=prod.get('unit_label'),
-            type=prod.get('type'),
-            updated=prod['updated'],
-            url=prod.get('url')
-        )
-        products.append(product)
-    _product_cache.update_cache(products)
+
+def initialize_product_cache() -> str:
+    """
+    Loads the catalog at startup. The persisted snapshot is used when available so that startup does not wait for, or
+    depend on, Stripe; an expired snapshot is refreshed in background. Returns the source the catalog was loaded from.
+    """
+    global _ttl, _max_staleness, _background_refresh, _price_fetch_concurrency
+    _ttl = safe_int(os.getenv('PRODUCT_CACHE_TTL')) or _ttl
+    _max_staleness = safe_int(os.getenv('PRODUCT_CACHE_MAX_STALENESS')) or _max_staleness
+    _background_refresh = os.getenv('PRODUCT_CACHE_BACKGROUND_REFRESH', 'true').lower() == 'true'
+    _price_fetch_concurrency = max(1, safe_int(os.getenv('STRIPE_CATALOG_CONCURRENCY')) or _price_fetch_concurrency)
+    initialize_product_snapshot()
+
+    _sync_from_snapshot(force=True)
+    if _product_cache.cache:
+        if _product_cache.is_expired():
+            _refresh_products_in_background()
+        return 'snapshot'
+
+    try:
+        _refresh_products()
+        return 'stripe'
+    except Exception as e:
+        print(f"Failed to load product catalog, it will be loaded on first request: {e}")
+        return 'unavailable'
+
+
+def _refresh_products():
+    # Concurrent callers wait for the single refresh in progress instead of starting their own
+    with _product_cache.refresh_lock:
+        if _product_cache.cache and not _product_cache.is_expired():
+            return
+        if _product_cache.cache and time.time() < _product_cache.next_refresh_attempt_time:
+            return
+        _reload_product_cache()
+
+
+def _refresh_products_in_background():
+    if time.time() < _product_cache.next_refresh_attempt_time:
+        return
+    if not _product_cache.refresh_lock.acquire(blocking=False):
+        return
+
+    def refresh():
+        try:
+            _reload_product_cache()
+        finally:
+            _product_cache.refresh_lock.release()
+
+    try:
+        threading.Thread(target=refresh, name='product-cache-refresh', daemon=True).start()
+    except Exception:
+        _product_cache.refresh_lock.release()
+        raise
+
+
+def _reload_product_cache():
+    _product_cache.begin_update()
+    try:
+        with publisher_lock():
+            # Another worker may have reloaded the catalog while this one was waiting for the lock
+            snapshot = read_snapshot()
+            if snapshot and time.time() < snapshot.published_at + _ttl:
+                _update_cache_from_snapshot(snapshot)
+                return
+
+            products = load_stripe_catalog()
+            _product_cache.update_cache(products, version=_publish_products(products))
+    except Exception as e:
+        _product_cache.abort_update()
+        if not _product_cache.cache:
+            raise
+        _product_cache.next_refresh_attempt_time = time.time() + _refresh_retry_delay
+        print(f"Failed to refresh product catalog, serving stale catalog: {e}")
+
+
+# Seconds between checks for a catalog snapshot published by another worker
+_snapshot_check_interval = 1
+
+
+def _sync_from_snapshot(force=False):
+    now = time.time()
+    if not force and now < _product_cache.next_snapshot_check_time:
+        return
+    _product_cache.next_snapshot_check_time = now + _snapshot_check_interval
+
+    header = read_snapshot_header(known_file_id=_product_cache.snapshot_file_id)
+    if header is not None and header.version != _product_cache.version:
+        if not force:
+            # Building the index of a new snapshot takes a while, the current catalog is served until it is ready
+            _load_snapshot_in_background()
+            return
+        _load_snapshot()
+    elif header is not None:
+        _product_cache.snapshot_file_id = header.file_id
+    _apply_snapshot_patches(blocking=force)
+
+
+def _load_snapshot_in_background():
+    if not _product_cache.refresh_lock.acquire(blocking=False):
+        return
+
+    def load():
+        try:
+            _load_snapshot()
+        except Exception as e:
+            print(f"Failed to load product catalog snapshot: {e}")
+        finally:
+            _product_cache.refresh_lock.release()
+
+    try:
+        threading.Thread(target=load, name='product-snapshot-load', daemon=True).start()
+    except Exception:
+        _product_cache.refresh_lock.release()
+        raise
+
+
+def _load_snapshot():
+    header = read_snapshot_header()
+    snapshot = read_snapshot()
+    if snapshot:
+        _update_cache_from_snapshot(snapshot)
+        _product_cache.snapshot_file_id = header.file_id if header else None
+
+
+def _update_cache_from_snapshot(snapshot: Snapshot):
+    products = [_product_from_dict(product) for product in snapshot.products]
+    _product_cache.update_cache(products, version=snapshot.version, published_at=snapshot.published_at)
+    _apply_snapshot_patches(blocking=True)
+
+
+def _apply_snapshot_patches(blocking: bool):
+    # Requests skip the check while another thread is applying patches
+    if not _product_cache.patches_lock.acquire(blocking=blocking):
+        return
+    try:
+        version = _product_cache.version
+        if not version:
+            return
+        cache_version, patches_version, offset = _product_cache.patches_position
+        if cache_version != version:
+            patches_version, offset = None, 0
+        patches_version, offset, patches = read_snapshot_patches(patches_version, offset)
+        if patches and patches_version == version:
+            _product_cache.apply_snapshot_patches(version, [
+                (product_id, _product_from_dict(product) if product else None) for product_id, product in patches
+            ])
+        _product_cache.patches_position = (version, patches_version, offset)
+    finally:
+        _product_cache.patches_lock.release()
+
+
+def _publish_products(products, published_at: Optional[float] = None) -> int:
+    try:
+        return publish_snapshot([_product_to_dict(product) for product in products], published_at=published_at)
+    except Exception as e:
+        print(f"Failed to publish product catalog snapshot: {e}")
+        return 0
+
+
+def _product_to_dict(product: StripeProduct) -> dict:
+    data = {product_field.name: getattr(product, product_field.name) for product_field in fields(product)}
+    data['default_price'] = asdict(product.default_price) if product.default_price else None
+    data['features'] = [dict(feature) for feature in product.features]
+    data['marketing_features'] = [dict(feature) for feature in product.marketing_features]
+    data['metadata'] = dict(product.metadata)
+    data['package_dimensions'] = dict(product.package_dimensions) if product.package_dimensions else None
+    return data
+
+
+def _product_from_dict(data: dict) -> StripeProduct:
+    # Snapshot stores products in the shape of Stripe objects
+    return _map_stripe_product(data, _map_stripe_price(data.get('default_price')))
+
+
+# Max number of Stripe page size
+_page_size = 100
+# Number of parallel price lookups used for default prices that Stripe did not expand
+_price_fetch_concurrency = 8
+
+
+def load_stripe_catalog() -> List[StripeProduct]:
+    """
+    Loads the whole Stripe catalog. Products are paged through with their default prices expanded inline, so a catalog
+    of N products costs ceil(N / 100) round trips instead of 1 + N.
+    """
+    products_pages = stripe.Product.list(limit=_page_size, expand=['data.default_price'])
+
+    products_data = []
+    unresolved_price_ids = set()
+    for prod in products_pages.auto_paging_iter():
+        default_price = prod.get('default_price')
+        if isinstance(default_price, str):
+            unresolved_price_ids.add(default_price)
+        products_data.append(prod)
+
+    resolved_prices = _retrieve_stripe_prices(unresolved_price_ids)
+
+    products = []
+    for prod in products_data:
+        default_price = prod.get('default_price')
+        if isinstance(default_price, str):
+            default_price = resolved_prices.get(default_price)
+        products.append(_map_stripe_product(prod, _map_stripe_price(default_price)))
     return products
 
 
+# Stripe doc reference: https://docs.stripe.com/api/prices/retrieve
+def _retrieve_stripe_prices(price_ids) -> Dict[str, dict]:
+    if not price_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(_price_fetch_concurrency, len(price_ids))) as executor:
+        prices = executor.map(stripe.Price.retrieve, price_ids)
+        return {price.id: price for price in prices}
+
+
+def _map_stripe_price(price) -> Optional[StripePrice]:
+    if not price:
+        return None
+    return StripePrice(
+        id=price['id'],
+        unit_amount=price.get('unit_amount'),
+        currency=_intern(price.get('currency'))
+    )
+
+
+def _map_stripe_product(prod, default_price: Optional[StripePrice]) -> StripeProduct:
+    # Values repeated across products are interned so that the catalog keeps a single copy of each
+    return StripeProduct(
+        id=prod['id'],
+        object=_intern(prod['object']),
+        active=prod['active'],
+        created=prod['created'],
+        default_price=default_price,
+        description=prod.get('description'),
+        images=tuple(prod.get('images') or ()),
+        features=tuple(_to_mapping(feature) for feature in prod.get('features') or ()),
+        livemode=prod.get('livemode', False),
+        attributes=tuple(_intern(attribute) for attribute in prod.get('attributes') or ()),
+        marketing_features=tuple(_to_mapping(feature) for feature in prod.get('marketing_features') or ()),
+        metadata=_to_mapping(prod.get('metadata') or {}),
+        name=prod['name'],
+        package_dimensions=_to_mapping(prod.get('package_dimensions')),
+        shippable=prod.get('shippable'),
+        statement_descriptor=prod.get('statement_descriptor'),
+        tax_code=_intern(prod.get('tax_code')),
+        unit_label=_intern(prod.get('unit_label')),
+        type=_intern(prod.get('type')),
+        updated=prod['updated'],
+        url=prod.get('url')
+    )
+
+
+# Only short values are interned, interning long free text would just grow the interpreter's string table
+_max_interned_length = 64
+
+
+def _intern(value):
+    if isinstance(value, str) and len(value) <= _max_interned_length:
+        return sys.intern(value)
+    return value
+
+
+def _to_mapping(value):
+    if value is None:
+        return None
+    return MappingProxyType({_intern(key): _intern(item) for key, item in value.items()})
+
+
 def get_cached_product_by_id(product_id: str) -> Optional[StripeProduct]:
-    global _product_cache
-    if _product_cache.is_expired():
-        get_stripe_products()
-    return _product_cache.get_product_by_id(product_id)
+    return get_product_index().by_id.get(product_id)
+
+
+def get_product_index() -> ProductIndex:
+    get_stripe_products()
+    return _product_cache.index
 
 
 def get_all_product_category_ids():
-    products = get_stripe_products()
-    category_ids = {product.metadata['category_id'] for product in products if 'category_id' in product.metadata}
-    return list(category_ids)
+    return list(get_product_index().category_ids)
+
+
+def is_stripe_catalog_event(event) -> bool:
+    return event['type'].split('.')[0] in ('product', 'price')
+
+
+# Stripe doc reference: https://docs.stripe.com/api/events/types#event_types-product.created
+def apply_stripe_catalog_event(event):
+    """
+    Patches a single cached product from a product.* or price.* webhook event instead of reloading the whole catalog.
+    The patch is appended to the shared snapshot so other workers apply it as well.
+    """
+    if not is_snapshot_enabled():
+        _apply_stripe_catalog_event(event)
+        return
+
+    with publisher_lock():
+        _sync_from_snapshot(force=True)
+        patch = _apply_stripe_catalog_event(event)
+        if patch and _product_cache.version:
+            product_id, product = patch
+            try:
+                data = _product_to_dict(product) if product else None
+                append_snapshot_patch(_product_cache.version, product_id, data)
+            except Exception as e:
+                print(f"Failed to publish product catalog patch: {e}")
+
+
+def _apply_stripe_catalog_event(event) -> Optional[Tuple[str, Optional[StripeProduct]]]:
+    event_type = event['type']
+    data = event['data']['object']
+
+    if event_type == 'product.deleted':
+        product_id, product = data['id'], None
+    elif event_type.startswith('product.'):
+        product_id, product = data['id'], _map_stripe_product(data, _resolve_default_price(data))
+    elif event_type.startswith('price.'):
+        product = _product_cache.get_product_by_id(data.get('product'))
+        if not product or not product.default_price or product.default_price.id != data['id']:
+            return None
+        default_price = _map_stripe_price(data) if event_type != 'price.deleted' else None
+        product_id, product = product.id, replace(product, default_price=default_price)
+    else:
+        return None
+
+    if not _product_cache.patch_product(product_id, product):
+        return None
+    return product_id, product
+
+
+def _resolve_default_price(product_data) -> Optional[StripePrice]:
+    default_price = product_data.get('default_price')
+    if not default_price or not isinstance(default_price, str):
+        return _map_stripe_price(default_price)
+
+    cached_product = _product_cache.get_product_by_id(product_data['id'])
+    if cached_product and cached_product.default_price and cached_product.default_price.id == default_price:
+        return cached_product.default_price
+    return _map_stripe_price(stripe.Price.retrieve(default_price))
@@ -0,0 +1,117 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import click
+import stripe
+
+from database import db
+from database.webhook_event import WebhookEvent
+from utils.lease_worker import LeaseQueueWorkers
+
+# Number of worker threads processing stored webhook events in this process, 0 leaves processing to other processes
+_worker_count = 2
+_claim_batch_size = 10
+# Time a worker has to process a claimed event before it can be claimed by another worker
+_processing_lease = timedelta(minutes=5)
+# Failed event is retried after 10 s, 20 s, 40 s, ... at most an hour apart, and given up after max attempts
+_retry_base_delay = 10
+_retry_max_delay = 3600
+_max_attempts = 10
+# Processed events are kept for replay for this long
+_processed_event_retention = timedelta(days=30)
+
+_workers = LeaseQueueWorkers(
+    'webhook-inbox',
+    queue=WebhookEvent,
+    claim=lambda: WebhookEvent.claim_events(limit=_claim_batch_size, lease=_processing_lease),
+    retry_base_delay=_retry_base_delay,
+    retry_max_delay=_retry_max_delay,
+    max_attempts=_max_attempts,
+    retention=_processed_event_retention
+)
+
+
+class PermanentWebhookError(Exception):
+    """
+    Raised by an event handler when retrying the event can not succeed.
+    """
+
+
+def initialize_webhook_inbox(app, handler):
+    """
+    Starts workers processing stored webhook events with handler, which receives the Stripe event, and registers
+    the webhook CLI commands.
+    """
+    global _worker_count
+    _worker_count = int(os.getenv('WEBHOOK_WORKERS', _worker_count))
+    _register_commands(app)
+
+    _workers.start(app, _worker_count, lambda event: _process_event(event, handler))
+
+
+def notify_webhook_inbox():
+    _workers.notify()
+
+
+def get_ordering_key(event):
+    data = event['data']['object']
+    event_type = event['type']
+    if event_type.startswith('checkout.session.'):
+        order_id = (data.get('metadata') or {}).get('order_id')
+        return f'order:{order_id}' if order_id else None
+    if event_type.startswith('product.'):
+        return f"product:{data['id']}"
+    if event_type.startswith('price.'):
+        product_id = data.get('product')
+        return f'product:{product_id}' if product_id else None
+    return None
+
+
+def _process_event(event, handler):
+    started = time.perf_counter()
+    # Inbox lag, time from receiving the event to start of this processing attempt
+    lag = (datetime.utcnow() - event.received_at).total_seconds() * 1000
+
+    try:
+        handler(stripe.Event.construct_from(json.loads(event.payload), stripe.api_key))
+    except PermanentWebhookError as e:
+        db.session.rollback()
+        WebhookEvent.mark_failed(event.id, str(e))
+        result = f"failed: {e}"
+    except Exception as e:
+        db.session.rollback()
+        result = _workers.retry_or_fail(event, e)
+    else:
+        WebhookEvent.mark_processed(event.id)
+        result = "processed"
+
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"Webhook event {event.id} ({event.type}) {result}, lag {lag:.0f} ms, processing {elapsed:.1f} ms")
+
+
+def _register_commands(app):
+    @app.cli.command('webhook-replay')
+    @click.argument('event_ids', nargs=-1)
+    @click.option('--since', type=click.DateTime(), help="Replay events received since this UTC time.")
+    @click.option('--failed', is_flag=True, help="Replay only failed events.")
+    def replay_webhook_events(event_ids, since, failed):
+        """
+        Schedules stored webhook events for processing again.
+        """
+        if not event_ids and not since and not failed:
+            raise click.UsageError("Specify event ids, --since or --failed")
+        replayed = WebhookEvent.replay_events(event_ids=event_ids, received_since=since, failed_only=failed)
+        click.echo(f"Scheduled {replayed} webhook events for processing")
+
+    @app.cli.command('webhook-stats')
+    def print_webhook_stats():
+        """
+        Prints number of stored webhook events by status and the inbox lag.
+        """
+        counts, oldest_received_at = WebhookEvent.get_inbox_stats()
+        for status, count in sorted(counts.items()):
+            click.echo(f"{status}: {count}")
+        lag = (datetime.utcnow() - oldest_received_at).total_seconds() if oldest_received_at else 0
+        click.echo(f"Inbox lag: {lag:.1f} s")
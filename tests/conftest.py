@@ -0,0 +1,71 @@
+import os
+
+import pytest
+from flask import Flask
+from flask_jwt_extended import JWTManager
+
+import payment.stripe_product as stripe_product
+from api.cart import cart_blueprint
+from api.order import order_blueprint
+from database import db
+from payment.stripe_product import ProductCache, _product_from_dict
+from utils.limiter import limiter
+from utils.query_counter import initialize_query_counter
+
+
+@pytest.fixture(scope='session')
+def postgres_url():
+    """
+    Database of the tests, TEST_POSTGRES_URL or a temporary server started by testing.postgresql. Tests are skipped
+    when neither is available.
+    """
+    url = os.getenv('TEST_POSTGRES_URL')
+    if url:
+        yield url
+        return
+
+    testing_postgresql = pytest.importorskip('testing.postgresql')
+    try:
+        postgresql = testing_postgresql.Postgresql()
+    except RuntimeError as e:
+        pytest.skip(f"PostgreSQL is not available: {e}")
+    yield postgresql.url()
+    postgresql.stop()
+
+
+@pytest.fixture
+def app(postgres_url):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = postgres_url
+    app.config['JWT_SECRET_KEY'] = 'test-secret-key-of-at-least-32-bytes'
+    app.config['RATELIMIT_ENABLED'] = False
+    JWTManager(app)
+    app.register_blueprint(cart_blueprint)
+    app.register_blueprint(order_blueprint)
+    db.init_app(app)
+    limiter.init_app(app)
+    initialize_query_counter(app, expose_header=True)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    products = [
+        {
+            'id': f'prod_{index}', 'object': 'product', 'active': True, 'created': 1000 + index,
+            'updated': 1000 + index, 'name': f'Product {index}', 'metadata': {'discount': '15'},
+            'default_price': {'id': f'price_{index}', 'unit_amount': 999, 'currency': 'eur'}
+        }
+        for index in range(3)
+    ]
+    product_cache = ProductCache()
+    product_cache.update_cache([_product_from_dict(product) for product in products])
+    monkeypatch.setattr(stripe_product, '_product_cache', product_cache)
+    return product_cache
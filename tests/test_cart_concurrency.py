@@ -0,0 +1,44 @@
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+from database import db
+from database.cart import Cart, CartItem
+
+_threads = 8
+_adds_per_thread = 25
+_products = ('prod_0', 'prod_1')
+
+
+def test_concurrent_adds_to_new_cart_keep_every_increment(app):
+    # Threads add to the same products, starting before the owner has a cart
+    added = [
+        [_products[(thread_index + index) % len(_products)] for index in range(_adds_per_thread)]
+        for thread_index in range(_threads)
+    ]
+    barrier = threading.Barrier(_threads)
+
+    def add_items(product_ids):
+        with app.app_context():
+            barrier.wait()
+            for product_id in product_ids:
+                Cart.add_item_to_cart(product_id, 1, guest_id='guest')
+
+    with ThreadPoolExecutor(max_workers=_threads) as executor:
+        list(executor.map(add_items, added))
+
+    with app.app_context():
+        carts = Cart.query.filter_by(guest_id='guest').all()
+        assert len(carts) == 1
+
+        rows = db.session.query(CartItem.product_id, func.count(), func.sum(CartItem.quantity)) \
+            .filter(CartItem.cart_id == carts[0].id) \
+            .group_by(CartItem.product_id) \
+            .all()
+        # One row per product, no increment lost
+        expected = Counter(product_id for product_ids in added for product_id in product_ids)
+        assert {product_id: (count, quantity) for product_id, count, quantity in rows} == {
+            product_id: (1, quantity) for product_id, quantity in expected.items()
+        }
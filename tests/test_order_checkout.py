@@ -0,0 +1,85 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import stripe
+
+from database import db
+from database.cart import Cart, CartItem
+from database.order import Order, OrderStatus
+
+_parallel_checkouts = 8
+
+
+def test_parallel_checkouts_of_cart_create_one_order(app, catalog, monkeypatch):
+    _create_cart(app, 'guest', {'prod_1': 2})
+
+    created_sessions = []
+    created_sessions_lock = threading.Lock()
+
+    def create_session(**kwargs):
+        # Keeps the cart locked while the other checkouts arrive
+        time.sleep(0.2)
+        with created_sessions_lock:
+            created_sessions.append(kwargs)
+            number = len(created_sessions)
+        return stripe.checkout.Session.construct_from({
+            'id': f'cs_test_{number}',
+            'url': f'https://checkout.stripe.com/c/pay/cs_test_{number}',
+            'expires_at': int(time.time()) + 3600
+        }, 'sk_test')
+
+    monkeypatch.setattr(stripe.checkout.Session, 'create', create_session)
+
+    barrier = threading.Barrier(_parallel_checkouts)
+
+    def checkout(_):
+        client = app.test_client()
+        barrier.wait()
+        return client.post('/order/create', json={'guest_id': 'guest'})
+
+    with ThreadPoolExecutor(max_workers=_parallel_checkouts) as executor:
+        responses = list(executor.map(checkout, range(_parallel_checkouts)))
+
+    assert sorted(response.status_code for response in responses) == [200] * (_parallel_checkouts - 1) + [201]
+    assert len({response.json['checkout_url'] for response in responses}) == 1
+    assert len({response.json['order_id'] for response in responses}) == 1
+    assert len(created_sessions) == 1
+
+    with app.app_context():
+        orders = Order.query.all()
+        assert [order.status for order in orders] == [OrderStatus.PENDING.value]
+        # Discounted price is rounded to whole cents, 999 - 15 %
+        assert [(item.product_id, item.quantity, item.price) for item in orders[0].items] == [('prod_1', 2, 849)]
+
+
+def test_checkout_waiting_for_cart_lock_times_out(app, catalog, monkeypatch):
+    _create_cart(app, 'guest', {'prod_1': 1})
+
+    monkeypatch.setattr('api.order._checkout_lock_timeout', timedelta(milliseconds=100))
+    monkeypatch.setattr(stripe.checkout.Session, 'create', _fail_session_create)
+    with app.app_context():
+        locked, cart = Cart.lock_cart_for_checkout(guest_id='guest')
+        assert locked and cart
+
+        response = _post_in_thread(app, '/order/create', {'guest_id': 'guest'})
+        assert response.status_code == 409, response.json
+
+
+def _fail_session_create(**kwargs):
+    raise AssertionError("Checkout session must not be created while the cart is locked")
+
+
+def _post_in_thread(app, path, body):
+    # The request runs in its own app context, and so its own database session and transaction
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(lambda: app.test_client().post(path, json=body)).result()
+
+
+def _create_cart(app, guest_id, quantities):
+    with app.app_context():
+        cart = Cart(guest_id=guest_id)
+        cart.items = [CartItem(product_id=product_id, quantity=quantity) for product_id, quantity in quantities.items()]
+        db.session.add(cart)
+        db.session.commit()
@@ -0,0 +1,48 @@
+import time
+
+import stripe
+
+
+def test_cart_query_budget(app, catalog):
+    client = app.test_client()
+
+    response = client.post('/cart/add', json={'guest_id': 'guest', 'product_id': 'prod_1', 'quantity': 2})
+    assert response.status_code == 201, response.json
+    _assert_query_budget(response, 2)
+
+    response = client.get('/cart', query_string={'guest_id': 'guest'})
+    assert response.status_code == 200, response.json
+    _assert_query_budget(response, 1)
+
+
+def test_order_query_budget(app, catalog, monkeypatch):
+    monkeypatch.setattr(stripe.checkout.Session, 'create', _create_session)
+    client = app.test_client()
+    client.post('/cart/add', json={'guest_id': 'guest', 'product_id': 'prod_1', 'quantity': 2})
+
+    response = client.post('/order/create', json={'guest_id': 'guest'})
+    assert response.status_code == 201, response.json
+    order_id = response.json['order_id']
+
+    # Checkout of the unchanged cart reuses the pending order
+    response = client.post('/order/create', json={'guest_id': 'guest'})
+    assert response.status_code == 200, response.json
+    assert response.json['order_id'] == order_id
+    _assert_query_budget(response, 4)
+
+    response = client.get('/order', query_string={'order_id': order_id, 'guest_id': 'guest'})
+    assert response.status_code == 200, response.json
+    _assert_query_budget(response, 1)
+
+
+def _create_session(**kwargs):
+    return stripe.checkout.Session.construct_from({
+        'id': 'cs_test_1',
+        'url': 'https://checkout.stripe.com/c/pay/cs_test_1',
+        'expires_at': int(time.time()) + 3600
+    }, 'sk_test')
+
+
+def _assert_query_budget(response, budget):
+    query_count = int(response.headers['X-SQL-Query-Count'])
+    assert query_count <= budget, f"{query_count} SQL queries, budget is {budget}"
@@ -1,3 +1,5 @@
+import base64
+import json
 import re
 from typing import Optional
 
@@ -13,3 +15,14 @@ def safe_int(value: Optional[str]) -> Optional[int]:
         return int(value)
     except (TypeError, ValueError):
         return None
+
+
+def encode_cursor(values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (AttributeError, ValueError, UnicodeError):
+        return None
@@ -0,0 +1,74 @@
+import threading
+from datetime import datetime, timedelta
+
+from utils.scheduler import run_periodically
+
+# Finished rows are purged this many seconds apart
+_purge_interval = 3600
+
+
+class LeaseQueueWorkers:
+    """
+    Background workers of a LeaseQueue model, retrying failed rows with exponential backoff.
+    """
+
+    def __init__(self, name: str, queue, claim, retry_base_delay: float, retry_max_delay: float, max_attempts: int,
+                 retention: timedelta, poll_interval: float = 5):
+        self.name = name
+        self.queue = queue
+        # Called with the app context pushed, returns the claimed rows
+        self.claim = claim
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.max_attempts = max_attempts
+        self.retention = retention
+        # Seconds between polls when no row was enqueued by this process
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+
+    def start(self, app, count: int, process, on_idle=None):
+        """
+        Starts count workers calling process with every claimed row, and the hourly purge of finished rows.
+        """
+        for index in range(count):
+            threading.Thread(
+                target=self._run_worker, args=(app, process, on_idle), name=f'{self.name}-{index}', daemon=True
+            ).start()
+
+        def purge():
+            with app.app_context():
+                purged = self.queue.purge_finished(datetime.utcnow() - self.retention)
+            print(f"Purged {purged} finished rows of {self.name}")
+
+        run_periodically(f'{self.name}-purge', _purge_interval, purge)
+
+    def notify(self):
+        # Wakes up workers of this process, workers of other processes pick the rows up on their next poll
+        self._wakeup.set()
+
+    def retry_or_fail(self, row, error) -> str:
+        # Returns the outcome to print
+        if row.attempts >= self.max_attempts:
+            self.queue.mark_failed(row.id, str(error))
+            return f"failed after {row.attempts} attempts: {error}"
+
+        delay = min(self.retry_base_delay * 2 ** (row.attempts - 1), self.retry_max_delay)
+        self.queue.schedule_retry(row.id, str(error), datetime.utcnow() + timedelta(seconds=delay))
+        return f"retrying in {delay} s: {error}"
+
+    def _run_worker(self, app, process, on_idle):
+        while True:
+            try:
+                with app.app_context():
+                    rows = self.claim()
+                    for row in rows:
+                        process(row)
+            except Exception as e:
+                print(f"Worker of {self.name} failed: {e}")
+                rows = []
+
+            if not rows:
+                if on_idle:
+                    on_idle()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
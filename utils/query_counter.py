@@ -0,0 +1,33 @@
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_query_count_header = 'X-SQL-Query-Count'
+
+
+def initialize_query_counter(app, expose_header=False):
+    """
+    Counts SQL statements executed while handling each request, available as get_query_count() and, when
+    expose_header is set, returned in the X-SQL-Query-Count response header.
+    """
+
+    @app.before_request
+    def reset_query_count():
+        g.sql_query_count = 0
+
+    if expose_header:
+        @app.after_request
+        def add_query_count_header(response):
+            response.headers[_query_count_header] = str(get_query_count())
+            return response
+
+
+def get_query_count() -> int:
+    return g.get('sql_query_count', 0) if has_app_context() else 0
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(_conn, _cursor, _statement, _parameters, _context, _executemany):
+    # Statements run by background threads have their own app context without a request count
+    if has_app_context() and 'sql_query_count' in g:
+        g.sql_query_count += 1
@@ -0,0 +1,21 @@
+import threading
+import time
+
+
+def run_periodically(name: str, interval: float, job):
+    """
+    Runs job every interval seconds on a daemon thread, the first run is after one interval. Errors are printed and
+    do not stop later runs.
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                job()
+            except Exception as e:
+                print(f"Periodic job {name} failed: {e}")
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
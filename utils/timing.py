@@ -0,0 +1,21 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, (time.perf_counter() - started) * 1000))
+
+    def report(self) -> str:
+        total = (time.perf_counter() - self.started) * 1000
+        phases = ', '.join(f'{name}: {elapsed:.1f} ms' for name, elapsed in self.phases)
+        return f"App started in {total:.1f} ms ({phases})"